@@ -0,0 +1,33 @@
+# Compare two sets of results from `run.py`, say from before and after a
+# change.
+#
+#     python benchmarks/compare.py before.json after.json
+
+import argparse
+import json
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report['meta'], {
+        (result['benchmark'], result['entries']): result for result in report['results']
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    before_meta, before = load_results(args.before)
+    after_meta, after = load_results(args.after)
+    print(f'before: {before_meta.get("revision")}, after: {after_meta.get("revision")}')
+    print(f'{"benchmark":>16} {"entries":>9} {"before ms":>12} {"after ms":>12} {"ratio":>7}')
+    for key in sorted(before.keys() & after.keys()):
+        before_ms = before[key]['median_ms']
+        after_ms = after[key]['median_ms']
+        ratio = after_ms / before_ms if before_ms else float('inf')
+        print(f'{key[0]:>16} {key[1]:>9} {before_ms:12.2f} {after_ms:12.2f} {ratio:7.2f}')
+
+if __name__ == '__main__':
+    main()
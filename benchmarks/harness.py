@@ -0,0 +1,158 @@
+# Helpers to drive the plugin outside of Sublime: load it against the stub
+# `sublime` modules in `stubs/`, and make up realistic histories for it to work
+# on.
+
+import importlib
+import json
+import os.path
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import types
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCHMARKS_DIR)
+# Sublime imports the plugin as a module in a package named after the package
+# directory, so do the same.
+PACKAGE_NAME = 'FrecentHistory'
+
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, 'stubs'))
+
+import sublime  # pylint: disable=wrong-import-position
+
+def import_plugin():
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [PACKAGE_DIR]
+        sys.modules[PACKAGE_NAME] = package
+    return importlib.import_module(f'{PACKAGE_NAME}.frecent_history')
+
+# Get the plugin module with all of its global state fresh, as if Sublime had
+# just started, and with no windows open.
+def fresh_plugin(**settings):
+    sublime.reset()
+    plugin = importlib.reload(import_plugin())
+    plugin_settings = sublime.load_settings(plugin.SETTINGS_FILE_NAME)
+    # Debug output would swamp any timings.
+    plugin_settings.set('print_debug', False)
+    for key, value in settings.items():
+        plugin_settings.set(key, value)
+    return plugin
+
+# A stand-in for the plugin's `LocalFilesystem` that pretends every path
+# exists, so we don't need the files on disk. Stats on paths under a hung mount
+# point block, like a dead network mount, until `release` is called.
+class FakeFilesystem:
+
+    def __init__(self, mount_points=('/',), hung_mount_points=(), remote_mount_points=()):
+        self.mount_points = list(mount_points) + list(hung_mount_points) + list(remote_mount_points)
+        self.remote_mount_points = list(hung_mount_points) + list(remote_mount_points)
+        self.hung_prefixes = [mount_point.rstrip('/') + '/' for mount_point in hung_mount_points]
+        self.released = threading.Event()
+
+    def stat(self, path):
+        if any(path.startswith(prefix) for prefix in self.hung_prefixes):
+            self.released.wait()
+        return os.stat_result((0,) * 10)
+
+    def get_mount_points(self):
+        return list(self.mount_points)
+
+    def get_remote_mount_points(self):
+        return list(self.remote_mount_points)
+
+    def release(self):
+        self.released.set()
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=PACKAGE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# To tell results apart when comparing them.
+def get_run_metadata():
+    return dict(
+        revision=get_git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=int(time.time()),
+    )
+
+# Synthetic histories.
+
+WORDS = [
+    'api', 'app', 'cache', 'client', 'cmd', 'common', 'config', 'core', 'data',
+    'docs', 'handlers', 'internal', 'io', 'lib', 'models', 'net', 'parser',
+    'scripts', 'server', 'src', 'tests', 'ui', 'utils', 'views',
+]
+# Repeated to weight the distribution towards the common ones.
+EXTENSIONS = [
+    '.py', '.py', '.py', '.py', '.js', '.ts', '.ts', '.md', '.md', '.json',
+    '.yaml', '.txt', '.c', '.h', '.go', '.rs', '.html', '.css', '.sh',
+]
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Paths in a history mostly come from a handful of projects, where a few
+# projects get most of the use. Each project grows a tree of directories as we
+# go, with around `FILES_PER_DIRECTORY` files per directory. A few paths come
+# from elsewhere, like dotfiles and system files.
+FILES_PER_DIRECTORY = 8
+
+class SyntheticHistory:
+
+    def __init__(self, n_entries, now, home='/home/user', seed=0):
+        rng = random.Random(seed)
+        n_projects = max(2, round(n_entries ** 0.5 / 4))
+        self.project_roots = [
+            f'{home}/src/{rng.choice(WORDS)}-{i}' for i in range(n_projects)
+        ]
+        other_roots = [home, f'{home}/.config', '/etc', '/usr/lib/python3.8']
+        # Map from root to the directories under it so far, including itself.
+        directories = {root: [root] for root in self.project_roots + other_roots}
+        # Zipf-ish: the project at rank `r` gets used about `1 / r` as much as
+        # the most popular one.
+        cum_weights = []
+        total = 0
+        for rank in range(n_projects):
+            total += 1 / (rank + 1)
+            cum_weights.append(total)
+
+        paths = set()
+        while len(paths) < n_entries:
+            if rng.random() < 0.05:
+                root = rng.choice(other_roots)
+            else:
+                root = rng.choices(self.project_roots, cum_weights=cum_weights)[0]
+            root_directories = directories[root]
+            directory = rng.choice(root_directories)
+            if rng.random() < 1 / FILES_PER_DIRECTORY:
+                directory = f'{directory}/{rng.choice(WORDS)}{len(root_directories)}'
+                root_directories.append(directory)
+            name = f'{rng.choice(WORDS)}_{rng.randrange(n_entries)}{rng.choice(EXTENSIONS)}'
+            paths.add(f'{directory}/{name}')
+        self.paths = sorted(paths)
+
+        # Most files are seen a few times, and a few are seen a lot, mostly in
+        # the last week or so.
+        self.entries = {}
+        for path in self.paths:
+            last_seen = now - int(rng.expovariate(1 / (7 * SECONDS_PER_DAY)))
+            self.entries[path] = dict(
+                added=last_seen - int(rng.expovariate(1 / (30 * SECONDS_PER_DAY))),
+                last_seen=last_seen,
+                inserts=min(10000, int(rng.paretovariate(1.2))),
+            )
+
+    # Write in the plain JSON format the plugin has always been able to read.
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.entries, f)
+
+# /Synthetic histories.
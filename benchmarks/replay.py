@@ -0,0 +1,183 @@
+# Replay a trace recorded with the plugin's `record_trace` setting, with a clock
+# that follows the trace rather than the wall clock, so every replay of a trace
+# builds the same history and shows the same panels. Reports how long the
+# plugin took to handle each kind of event, and how highly the panel ranked the
+# entries the user actually picked.
+#
+#     python benchmarks/replay.py ~/.sublime_file_history.trace --history history.json
+#
+# By default we pretend every path exists, so a trace replays the same way on
+# any machine. With `--real-filesystem` the plugin checks the disk as usual, and
+# forgets paths that aren't there, so replay on the machine the trace came from.
+
+import argparse
+from collections import defaultdict
+import json
+import os.path
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import harness
+import sublime
+
+class ReplayClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance_to(self, t):
+        self.now = max(self.now, t)
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def replay(plugin, events):
+    clock = ReplayClock(events[0][0] if events else 0)
+    plugin.clock = clock
+    sublime.set_monotonic_clock(clock.monotonic)
+
+    listener = plugin.OpenFrecentFileEvent()
+    windows = {}
+    commands = {}
+    durations_ms = defaultdict(list)
+    # For each pick, where the pick was in the recorded panel and in ours.
+    picks = []
+
+    for event in events:
+        t, kind, window_id = event[:3]
+        # Anything the plugin scheduled for before this event happens first.
+        sublime.run_timeouts_until(t, clock.advance_to)
+        clock.advance_to(t)
+
+        if kind == 'w':
+            windows[window_id] = sublime.Window(event[3])
+            continue
+        window = windows[window_id]
+
+        pre = time.perf_counter()
+        if kind == 'a':
+            path = event[3]
+            view = window.new_file() if path is None else window.open_file(path)
+            listener.on_activated_async(view)
+        elif kind == 'p':
+            if window_id not in commands:
+                commands[window_id] = plugin.OpenFrecentFileCommand(window)
+            # Traces from before the related mode don't have its flag.
+            commands[window_id].run(
+                use_master=event[3],
+                open_status_filter=event[4],
+                related=event[5] if len(event) > 5 else False,
+            )
+        elif kind == 's':
+            if window.quick_panel is None:
+                continue
+            recorded_index, path = event[3], event[4]
+            on_select = window.quick_panel['on_select']
+            # The rows we showed are bound into the callback.
+            panel_paths = [row['path'] for row in on_select.args[0]]
+            if path is None:
+                index = -1
+            else:
+                index = panel_paths.index(path) if path in panel_paths else None
+                picks.append(dict(recorded=recorded_index, replayed=index))
+            window.quick_panel = None
+            on_select(-1 if index is None else index)
+        durations_ms[kind].append(1000 * (time.perf_counter() - pre))
+
+    # Let anything still queued up finish.
+    sublime.run_timeouts_until(float('inf'), clock.advance_to)
+    return durations_ms, picks
+
+def summarize_picks(picks, key):
+    ranks = [pick[key] for pick in picks]
+    return dict(
+        # A pick that wasn't in the panel at all counts for nothing.
+        mean_reciprocal_rank=statistics.mean(
+            [0 if rank is None else 1 / (rank + 1) for rank in ranks]
+        ) if ranks else None,
+        top_1=sum(rank == 0 for rank in ranks) / len(ranks) if ranks else None,
+        top_5=sum(rank is not None and rank < 5 for rank in ranks) / len(ranks) if ranks else None,
+        missing=sum(rank is None for rank in ranks),
+    )
+
+def main():
+    # Entries with equal scores end up in the panel in set iteration order,
+    # which depends on string hashing, which Python randomizes per process. So
+    # pin the hash seed, or replays wouldn't agree on ties.
+    if os.environ.get('PYTHONHASHSEED') != '0':
+        os.environ['PYTHONHASHSEED'] = '0'
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('trace')
+    parser.add_argument('--history', help='History file to start from, default empty.')
+    parser.add_argument(
+        '--set', metavar='KEY=JSON', action='append', default=[],
+        help='Override a plugin setting, say --set activation_dwell_ms=100.',
+    )
+    parser.add_argument(
+        '--real-filesystem', action='store_true',
+        help='Check paths exist on disk, rather than pretending they all do.',
+    )
+    parser.add_argument('--output', help='Where to write JSON results, default stdout.')
+    args = parser.parse_args()
+    settings = {}
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        settings[key] = json.loads(value)
+
+    events = load_trace(args.trace)
+    with tempfile.TemporaryDirectory() as directory:
+        # Work on a copy, as the plugin saves as it goes.
+        history_path = os.path.join(directory, 'history.json')
+        if args.history is not None:
+            shutil.copy(args.history, history_path)
+        plugin = harness.fresh_plugin(**dict(
+            settings, history_path=history_path, record_trace=False,
+        ))
+        if not args.real_filesystem:
+            plugin.filesystem = harness.FakeFilesystem()
+        # Load the history up front, as Sublime would at startup, and wait for
+        # it so the replay doesn't depend on how long it takes.
+        plugin.plugin_loaded()
+        plugin.history_load['future'].result()
+        pre = time.perf_counter()
+        durations_ms, picks = replay(plugin, events)
+        total_ms = 1000 * (time.perf_counter() - pre)
+
+    report = dict(
+        meta=dict(harness.get_run_metadata(), trace=os.path.abspath(args.trace), settings=settings),
+        events=len(events),
+        total_ms=total_ms,
+        timings={
+            kind: dict(
+                count=len(kind_durations_ms),
+                total_ms=sum(kind_durations_ms),
+                median_ms=statistics.median(kind_durations_ms),
+                max_ms=max(kind_durations_ms),
+            )
+            for kind, kind_durations_ms in sorted(durations_ms.items())
+        },
+        picks=len(picks),
+        recorded_ranking=summarize_picks(picks, 'recorded'),
+        replayed_ranking=summarize_picks(picks, 'replayed'),
+    )
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
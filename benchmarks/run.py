@@ -0,0 +1,453 @@
+# Time the plugin's heavy operations on synthetic histories of various sizes,
+# outside of Sublime. Results are written as JSON, so runs from different
+# versions can be compared with `compare.py`.
+#
+#     python benchmarks/run.py --sizes 1000 10000 100000 --output results.json
+#
+# Some benchmarks also check the plugin got things right. With `--check`, we
+# exit with an error if any of those checks failed, say to run the stress test
+# on its own:
+#
+#     python benchmarks/run.py --benchmarks stress --check
+
+import argparse
+from contextlib import contextmanager
+import gc
+import json
+import os.path
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import harness
+import sublime
+
+# How many paths the plugin sees between saves, see `SAVE_EVERY` in the plugin.
+SAVE_EVERY = 50
+
+BENCHMARKS = {}
+
+# Register a benchmark. It's called once per repetition with a `Fixture`, and
+# should do its setup and then time the interesting part with `fixture.timed()`.
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+class Fixture:
+
+    def __init__(self, n_entries, directory):
+        self.n_entries = n_entries
+        self.directory = directory
+        self.now = int(time.time())
+        self.history = harness.SyntheticHistory(n_entries, now=self.now)
+        self.history_path = os.path.join(directory, f'history-{n_entries}.json')
+        self.history.write(self.history_path)
+        self.duration_ms = None
+        # Anything else a benchmark wants to report.
+        self.extra = {}
+        # What went wrong, from `check`.
+        self.failures = []
+
+    # By default we save every entry, so saves cost what they would for a
+    # history of this size.
+    def fresh_plugin(self, **settings):
+        return harness.fresh_plugin(**dict(
+            dict(
+                history_path=os.path.join(self.directory, 'saved-history.json'),
+                max_master_entries=self.n_entries,
+            ),
+            **settings
+        ))
+
+    def loaded_plugin(self, **settings):
+        plugin = self.fresh_plugin(**settings)
+        plugin.load_master_history_from_file(self.history_path)
+        return plugin
+
+    def check(self, condition, message):
+        if not condition:
+            self.failures.append(message)
+
+    @contextmanager
+    def timed(self):
+        pre = time.perf_counter()
+        yield
+        self.duration_ms = 1000 * (time.perf_counter() - pre)
+
+# A clock that can jump ahead, to get past a wait without waiting for it, like
+# a mount's backoff. Anything else, like stats timing out, is in real time.
+class SkippingClock:
+
+    def __init__(self):
+        self.skipped = 0
+
+    def time(self):
+        return time.time() + self.skipped
+
+    def monotonic(self):
+        return time.monotonic() + self.skipped
+
+    def skip(self, seconds):
+        self.skipped += seconds
+
+@benchmark('load')
+def bench_load(fixture):
+    plugin = fixture.fresh_plugin()
+    with fixture.timed():
+        plugin.load_master_history_from_file(fixture.history_path)
+
+# What the loaded history costs to keep in memory, per entry. The time is for
+# the load with allocation tracing on, so isn't comparable with 'load'.
+@benchmark('memory')
+def bench_memory(fixture):
+    plugin = fixture.fresh_plugin()
+    gc.collect()
+    tracemalloc.start()
+    with fixture.timed():
+        plugin.load_master_history_from_file(fixture.history_path)
+    gc.collect()
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fixture.extra['bytes_per_entry'] = current_bytes / fixture.n_entries
+    fixture.extra['peak_bytes_per_entry'] = peak_bytes / fixture.n_entries
+
+# A save after seeing a few paths. In the JSON format, that's a full write.
+@benchmark('save')
+def bench_save(fixture, n_seen=SAVE_EVERY):
+    plugin = fixture.loaded_plugin()
+    see_paths(plugin, fixture, n_seen)
+    with fixture.timed():
+        plugin.save_master_history_to_file(plugin.get_history_path(), now=fixture.now)
+
+# The same in the ranked format, where we append just what changed to a file
+# we've written in full before.
+@benchmark('save_ranked')
+def bench_save_ranked(fixture, n_seen=SAVE_EVERY):
+    history_path = os.path.join(fixture.directory, 'saved-history.ranked')
+    if os.path.exists(history_path):
+        os.remove(history_path)
+    plugin = fixture.loaded_plugin(history_file_format='ranked', history_path=history_path)
+    plugin.save_master_history_to_file(history_path, now=fixture.now)
+    see_paths(plugin, fixture, n_seen)
+    with fixture.timed():
+        plugin.save_master_history_to_file(history_path, now=fixture.now)
+    fixture.extra['file_bytes'] = os.path.getsize(history_path)
+
+# Keep saving in the ranked format, with changes appended each time, until
+# there are enough of them that the file gets written out in full again, and
+# then some more. Checks none of the saves got skipped on the way, as they would
+# if we mistook the appended changes for extra entries.
+@benchmark('save_ranked_cycle')
+def bench_save_ranked_cycle(fixture, n_saves_per_rewrite=4, n_rewrites=2):
+    history_path = os.path.join(fixture.directory, 'saved-history.ranked')
+    if os.path.exists(history_path):
+        os.remove(history_path)
+    plugin = fixture.loaded_plugin(history_file_format='ranked', history_path=history_path)
+    plugin.save_master_history_to_file(history_path, now=fixture.now)
+    n_changes_before_rewrite = max(plugin.MIN_CHANGES_BEFORE_REWRITE, fixture.n_entries // 4)
+    n_seen = n_changes_before_rewrite // n_saves_per_rewrite + 1
+    paths = fixture.history.paths
+    window = sublime.Window(fixture.history.project_roots[:1])
+    with plugin.history_state.writing() as state:
+        state.save_cycle = iter(lambda: False, True)
+    with fixture.timed():
+        for i in range(n_saves_per_rewrite * n_rewrites + 1):
+            for j in range(n_seen):
+                path = paths[(i * n_seen + j) % len(paths)]
+                plugin.record_seen_path_in_window(window, path, fixture.now + i)
+            plugin.save_master_history_to_file(history_path, now=fixture.now + i)
+
+    counters = plugin.metrics['counters']
+    fixture.extra['saves'] = counters.get('saves', 0)
+    fixture.extra['saves_appended'] = counters.get('saves_appended', 0)
+    fixture.extra['saves_skipped'] = counters.get('saves_skipped', 0)
+    with plugin.history_state.lock:
+        n_dirty = len(plugin.history_state.dirty_paths)
+    fixture.check(fixture.extra['saves_skipped'] == 0, f'{fixture.extra["saves_skipped"]} saves skipped')
+    fixture.check(fixture.extra['saves'] > n_rewrites, f'Only {fixture.extra["saves"]} full saves')
+    fixture.check(n_dirty == 0, f'{n_dirty} changes left unsaved')
+
+def see_paths(plugin, fixture, n_seen):
+    window = sublime.Window(fixture.history.project_roots[:1])
+    with plugin.history_state.writing() as state:
+        # Keep the saves we're not timing out of the way.
+        state.save_cycle = iter(lambda: False, True)
+    for path in fixture.history.paths[:n_seen]:
+        plugin.record_seen_path_in_window(window, path, fixture.now)
+
+# Start the plugin and show the panel as soon as the first chunk of history is
+# in, as a user opening it right after Sublime starts might. Times how long
+# until that first panel, and reports how long until the full history is in.
+def run_startup(fixture, history_path):
+    plugin = fixture.fresh_plugin(history_path=history_path)
+    plugin.filesystem = harness.FakeFilesystem()
+    window = sublime.Window(fixture.history.project_roots[:1])
+    pre = time.perf_counter()
+    with fixture.timed():
+        plugin.plugin_loaded()
+        plugin.history_load['first_chunk'].result()
+        command = plugin.OpenFrecentFileCommand(window)
+        command.run(use_master=True)
+    fixture.extra['first_panel_rows'] = len(window.quick_panel['items'])
+    plugin.history_load['future'].result()
+    sublime.run_timeouts()
+    fixture.extra['full_panel_ms'] = 1000 * (time.perf_counter() - pre)
+    fixture.extra['full_panel_rows'] = len(window.quick_panel['items'])
+
+@benchmark('startup')
+def bench_startup(fixture):
+    run_startup(fixture, fixture.history_path)
+
+@benchmark('startup_ranked')
+def bench_startup_ranked(fixture):
+    ranked_history_path = os.path.join(fixture.directory, f'history-{fixture.n_entries}.ranked')
+    if not os.path.exists(ranked_history_path):
+        plugin = fixture.loaded_plugin(history_file_format='ranked')
+        plugin.save_master_history_to_file(ranked_history_path, now=fixture.now)
+    run_startup(fixture, ranked_history_path)
+
+@benchmark('populate_window')
+def bench_populate_window(fixture):
+    plugin = fixture.loaded_plugin()
+    window = sublime.Window(fixture.history.project_roots[:2])
+    with fixture.timed():
+        plugin.populate_window_history_from_master(window)
+
+# Populate a window as a task, as the panel does for a window opened after the
+# load. Reports the longest slice, which is how long it could hold up anything
+# else on the async thread.
+@benchmark('populate_window_sliced')
+def bench_populate_window_sliced(fixture):
+    plugin = fixture.loaded_plugin()
+    window = sublime.Window(fixture.history.project_roots[:2])
+    with fixture.timed():
+        plugin.start_window_population(window, plugin.TaskPriority.HIGH)
+        sublime.run_timeouts()
+    slices = plugin.metrics['timings']['Task slice']
+    fixture.extra['slices'] = slices.count
+    fixture.extra['median_slice_ms'], = slices.percentiles([50])
+    # Includes any full garbage collection that lands in a slice.
+    fixture.extra['longest_slice_ms'] = slices.max_ms
+
+# Remove a few paths we found missing, with many windows open.
+@benchmark('remove_paths')
+def bench_remove_paths(fixture, n_windows=20, n_removed=100):
+    plugin = fixture.loaded_plugin()
+    roots = fixture.history.project_roots
+    for i in range(n_windows):
+        plugin.populate_window_history_from_master(sublime.Window([roots[i % len(roots)]]))
+    with plugin.history_state.lock:
+        for path in fixture.history.paths[::max(1, len(fixture.history.paths) // n_removed)]:
+            plugin.history_state.paths_to_remove.add(plugin.path_table.lookup(path))
+    with fixture.timed():
+        plugin.remove_paths_to_remove()
+
+@benchmark('ranking')
+def bench_ranking(fixture):
+    plugin = fixture.loaded_plugin()
+    master_history = plugin.history_state.snapshot().master_history
+    with fixture.timed():
+        plugin.limit_entries(master_history, n=1000, now=fixture.now)
+
+# The whole of a panel run over the master history: gathering, scoring and
+# rendering a row per entry.
+@benchmark('panel')
+def bench_panel(fixture):
+    plugin = fixture.loaded_plugin()
+    window = sublime.Window(fixture.history.project_roots[:1])
+    command = plugin.OpenFrecentFileCommand(window)
+    with fixture.timed():
+        command.run(use_master=True)
+    window.quick_panel['on_select'](-1)
+
+# Record paths from several threads while other threads run the panel, as the
+# async and main threads do in Sublime. Checks no updates get lost on the way.
+@benchmark('stress')
+def bench_stress(fixture, n_writers=3, n_records=500, n_readers=2, n_panel_runs=10):
+    # Saves happen every few records here, so keep them to a realistic size.
+    plugin = fixture.loaded_plugin(max_master_entries=1000)
+    windows = [sublime.Window([root]) for root in fixture.history.project_roots[:n_writers]]
+    commands = [plugin.OpenFrecentFileCommand(window) for window in windows[:n_readers]]
+    paths = fixture.history.paths[:1000]
+    errors = []
+
+    def count_inserts():
+        return sum(
+            entry.inserts for entry in plugin.history_state.snapshot().master_history.values()
+        )
+    inserts_before = count_inserts()
+
+    def write(window):
+        try:
+            for i in range(n_records):
+                plugin.record_seen_path_in_window(window, paths[i % len(paths)], fixture.now)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(repr(e))
+
+    def read(command):
+        try:
+            for _ in range(n_panel_runs):
+                command.run()
+                command.window.quick_panel['on_select'](-1)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(repr(e))
+
+    threads = (
+        [threading.Thread(target=write, args=(window,)) for window in windows]
+        + [threading.Thread(target=read, args=(command,)) for command in commands]
+    )
+    with fixture.timed():
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    lost_updates = inserts_before + n_writers * n_records - count_inserts()
+    fixture.extra['errors'] = errors
+    fixture.extra['lost_updates'] = lost_updates
+    fixture.check(not errors, f'{len(errors)} threads raised: {errors}')
+    fixture.check(lost_updates == 0, f'{lost_updates} updates were lost')
+
+# Open and close windows over a long session. Each new window gets its history
+# populated, so would keep it around forever if we never noticed it closing.
+# We only tell the plugin about some of the closes, as Sublime doesn't always,
+# and leave it to notice the rest.
+@benchmark('window_churn')
+def bench_window_churn(fixture, n_windows=200, n_records=5, announce_every=2):
+    # As in `bench_stress`, keep the saves we trigger to a realistic size.
+    plugin = fixture.loaded_plugin(max_master_entries=1000)
+    # Rather than wait for the plugin to check each window is gone.
+    plugin.clock = SkippingClock()
+    sublime.set_monotonic_clock(plugin.clock.monotonic)
+    listener = plugin.OpenFrecentFileEvent()
+    paths = fixture.history.paths[:n_records]
+    with fixture.timed():
+        for i in range(n_windows):
+            window = sublime.Window([fixture.history.project_roots[i % len(fixture.history.project_roots)]])
+            plugin.populate_window_history_from_master(window)
+            for path in paths:
+                plugin.record_seen_path_in_window(window, path, fixture.now)
+            if i % announce_every == 0:
+                listener.on_pre_close_window(window)
+            window.close()
+            plugin.clock.skip(plugin.WINDOW_CLOSE_WAIT_MS / 1000)
+            sublime.run_timeouts()
+            plugin.drain_activation_queue()
+        plugin.forget_closed_windows()
+
+    with plugin.history_state.lock:
+        fixture.extra['windows_left'] = len(plugin.history_state.window_paths)
+    fixture.check(fixture.extra['windows_left'] == 0, f'{fixture.extra["windows_left"]} closed windows left')
+
+# With the most used project on a mount that has stopped responding, pick its
+# files from the panel and activate them. Only the first check should wait, and
+# nothing on the mount should be forgotten.
+@benchmark('hung_mount')
+def bench_hung_mount(fixture, n_picks=20, timeout_ms=50):
+    plugin = fixture.loaded_plugin(existence_check_timeout_ms=timeout_ms)
+    hung_root = fixture.history.project_roots[0]
+    plugin.filesystem = harness.FakeFilesystem(hung_mount_points=[hung_root])
+    window = sublime.Window([hung_root])
+    plugin.populate_window_history_from_master(window)
+    command = plugin.OpenFrecentFileCommand(window)
+    n_entries_before = len(plugin.history_state.master_history)
+    pick_durations_ms = []
+    with fixture.timed():
+        for i in range(n_picks):
+            command.run()
+            pre = time.perf_counter()
+            window.quick_panel['on_select'](i)
+            plugin.record_path_in_window(window, window.active_view().file_name(), fixture.now)
+            pick_durations_ms.append(1000 * (time.perf_counter() - pre))
+    plugin.filesystem.release()
+
+    fixture.extra['slowest_pick_ms'] = max(pick_durations_ms)
+    fixture.extra['median_pick_ms'] = statistics.median(pick_durations_ms)
+    fixture.extra['entries_lost'] = n_entries_before - len(plugin.history_state.master_history)
+    fixture.check(fixture.extra['entries_lost'] == 0, f'{fixture.extra["entries_lost"]} entries lost')
+
+# Keep retrying a hung mount each time its backoff runs out, then check a path
+# on a healthy mount. The retries shouldn't use up the workers the healthy
+# mount needs, so its check should come back straight away, and it should stay
+# healthy.
+@benchmark('hung_mount_retry')
+def bench_hung_mount_retry(fixture, n_retries=8, timeout_ms=50):
+    plugin = fixture.loaded_plugin(existence_check_timeout_ms=timeout_ms)
+    plugin.clock = SkippingClock()
+    hung_root = fixture.history.project_roots[0]
+    plugin.filesystem = harness.FakeFilesystem(mount_points=['/'], hung_mount_points=[hung_root])
+    hung_path = os.path.join(hung_root, 'a.py')
+    healthy_path = os.path.join(fixture.history.project_roots[1], 'a.py')
+    for _ in range(n_retries):
+        plugin.check_path_exists(hung_path)
+        plugin.clock.skip(plugin.MOUNT_RETRY_MAX_MS / 1000)
+    with fixture.timed():
+        existence = plugin.check_path_exists(healthy_path)
+    plugin.filesystem.release()
+
+    fixture.extra['healthy_existence'] = existence.value
+    fixture.extra['unhealthy_mounts'] = sorted(plugin.filesystem_state['unhealthy_mounts'])
+    fixture.check(existence == plugin.PathExistence.EXISTS, f'Path on healthy mount was {existence.value}')
+
+def run_benchmarks(names, sizes, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n_entries in sizes:
+            print(f'Generating history with {n_entries} entries...', file=sys.stderr)
+            fixture = Fixture(n_entries, directory)
+            for name in names:
+                durations_ms = []
+                fixture.extra = {}
+                fixture.failures = []
+                for _ in range(repeat):
+                    BENCHMARKS[name](fixture)
+                    durations_ms.append(fixture.duration_ms)
+                result = dict(
+                    benchmark=name,
+                    entries=n_entries,
+                    repeat=repeat,
+                    min_ms=min(durations_ms),
+                    median_ms=statistics.median(durations_ms),
+                    max_ms=max(durations_ms),
+                    failures=fixture.failures,
+                    **fixture.extra,
+                )
+                print(
+                    f'{name:>16} {n_entries:>9} entries: '
+                    f'median {result["median_ms"]:10.2f} ms, min {result["min_ms"]:10.2f} ms',
+                    file=sys.stderr,
+                )
+                for failure in fixture.failures:
+                    print(f'{name:>16} {n_entries:>9} entries: FAILED: {failure}', file=sys.stderr)
+                results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Where to write JSON results, default stdout.')
+    parser.add_argument('--check', action='store_true', help='Exit with an error if any checks failed.')
+    args = parser.parse_args()
+
+    report = dict(
+        meta=harness.get_run_metadata(),
+        results=run_benchmarks(args.benchmarks, args.sizes, args.repeat),
+    )
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.check and any(result['failures'] for result in report['results']):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
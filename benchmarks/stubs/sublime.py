@@ -0,0 +1,237 @@
+# A stand-in for the parts of Sublime's `sublime` module the plugin uses, so it
+# can be imported and driven outside the editor. Windows and views are plain
+# in-memory objects, and timeouts wait in a queue until the caller runs them
+# with `run_timeouts`.
+
+import heapq
+import itertools
+import json
+import os.path
+import re
+import threading
+import time
+
+TRANSIENT = 4
+FORCE_GROUP = 8
+KEEP_OPEN_ON_FOCUS_LOST = 2
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_ids = itertools.count(1)
+
+# Timeouts.
+
+_timeouts = []
+_timeouts_lock = threading.Lock()
+_monotonic = time.monotonic
+
+# Schedule timeouts against a different clock, say a simulated one.
+def set_monotonic_clock(monotonic):
+    global _monotonic  # pylint: disable=global-statement
+    _monotonic = monotonic
+
+def set_timeout(callback, delay=0):
+    with _timeouts_lock:
+        heapq.heappush(_timeouts, (_monotonic() + delay / 1000, next(_ids), callback))
+
+set_timeout_async = set_timeout
+
+# Run timeouts as they fall due. By default we wait for ones that are due in
+# the future too, until there are none left.
+def run_timeouts(wait=True):
+    while True:
+        with _timeouts_lock:
+            if not _timeouts:
+                return
+            due, _, callback = _timeouts[0]
+            delay = due - _monotonic()
+            if delay > 0 and not wait:
+                return
+        if delay > 0:
+            time.sleep(delay)
+        with _timeouts_lock:
+            heapq.heappop(_timeouts)
+        callback()
+
+# For a simulated clock: run the timeouts due by `until` without waiting,
+# calling `advance_to` to move the clock up to each one before running it.
+def run_timeouts_until(until, advance_to):
+    while True:
+        with _timeouts_lock:
+            if not _timeouts or _timeouts[0][0] > until:
+                return
+            due, _, callback = heapq.heappop(_timeouts)
+        advance_to(due)
+        callback()
+
+# /Timeouts.
+
+# Settings.
+
+class Settings:
+
+    def __init__(self, values):
+        self.values = values
+        self.on_change = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.on_change.values()):
+            callback()
+
+    def add_on_change(self, tag, callback):
+        self.on_change[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.on_change.pop(tag, None)
+
+_settings = {}
+
+# Sublime's settings files are JSON, plus comments and trailing commas.
+def _parse_sublime_json(text):
+    text = re.sub(r'^\s*//.*$', '', text, flags=re.MULTILINE)
+    text = re.sub(r',(\s*[}\]])', r'\1', text)
+    return json.loads(text)
+
+def load_settings(name):
+    if name not in _settings:
+        path = os.path.join(PACKAGE_DIR, name)
+        with open(path) as f:
+            _settings[name] = Settings(_parse_sublime_json(f.read()))
+    return _settings[name]
+
+# /Settings.
+
+# Windows and views.
+
+_windows = []
+
+def windows():
+    return list(_windows)
+
+def active_window():
+    return _windows[-1] if _windows else None
+
+def status_message(text):  # pylint: disable=unused-argument
+    pass
+
+class View:
+
+    def __init__(self, window, path=None):
+        self._id = next(_ids)
+        self._window = window
+        self._path = path
+        self._valid = True
+        self.name = None
+        self.text = ''
+
+    def id(self):
+        return self._id
+
+    def window(self):
+        return self._window if self._valid else None
+
+    def file_name(self):
+        return self._path
+
+    def is_valid(self):
+        return self._valid
+
+    def set_name(self, name):
+        self.name = name
+
+    def set_scratch(self, scratch):
+        pass
+
+    def set_read_only(self, read_only):
+        pass
+
+    def run_command(self, command, args=None):
+        if command == 'right_delete':
+            self.text = ''
+        elif command == 'append':
+            self.text += args['characters']
+
+class Window:
+
+    def __init__(self, folders=()):
+        self._id = next(_ids)
+        self._folders = list(folders)
+        self._views = []
+        self._panels = {}
+        self._valid = True
+        # The arguments of the last `show_quick_panel` call.
+        self.quick_panel = None
+        _windows.append(self)
+
+    def id(self):
+        return self._id
+
+    def is_valid(self):
+        return self._valid
+
+    def folders(self):
+        return list(self._folders)
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._views[-1] if self._views else None
+
+    def find_open_file(self, path):
+        for view in self._views:
+            if view.file_name() == path:
+                return view
+        return None
+
+    def open_file(self, path, flags=0):  # pylint: disable=unused-argument
+        view = self.find_open_file(path)
+        if view is None:
+            view = View(self, path)
+            self._views.append(view)
+        return view
+
+    def new_file(self):
+        view = View(self)
+        self._views.append(view)
+        return view
+
+    def focus_view(self, view):
+        if view in self._views:
+            self._views.remove(view)
+            self._views.append(view)
+
+    def create_output_panel(self, name, unlisted=False):  # pylint: disable=unused-argument
+        return self._panels.setdefault(name, View(self))
+
+    def run_command(self, command, args=None):
+        pass
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1, on_highlight=None):
+        self.quick_panel = dict(
+            items=items,
+            on_select=on_select,
+            flags=flags,
+            selected_index=selected_index,
+            on_highlight=on_highlight,
+        )
+
+    def close(self):
+        self._valid = False
+        for view in self._views:
+            view._valid = False  # pylint: disable=protected-access
+        _windows.remove(self)
+
+def reset():
+    for window in windows():
+        window.close()
+    with _timeouts_lock:
+        _timeouts.clear()
+    set_monotonic_clock(time.monotonic)
+    _settings.clear()
+
+# /Windows and views.
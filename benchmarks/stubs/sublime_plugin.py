@@ -0,0 +1,18 @@
+# A stand-in for the parts of Sublime's `sublime_plugin` module the plugin
+# uses, so it can be imported and driven outside the editor.
+
+class EventListener:
+    pass
+
+class WindowCommand:
+
+    def __init__(self, window):
+        self.window = window
+
+class TextCommand:
+
+    def __init__(self, view):
+        self.view = view
+
+class ApplicationCommand:
+    pass
@@ -3,15 +3,32 @@
 # pylint: disable=no-else-return
 # pylint: disable=no-else-continue
 
-from collections import defaultdict
+from array import array
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from contextlib import contextmanager
 from enum import Enum
+from types import BuiltinFunctionType, FunctionType, MappingProxyType, MethodType, ModuleType
+import cProfile
+import ctypes
+import ctypes.util
+import datetime
 import functools
+import gc
+import heapq
+import io
 import itertools
 import json
+import logging
 import os.path
-import pathlib
+import pstats
+import re
+import select
+import struct
+import sys
+import threading
 import time
+import tracemalloc
 
 import sublime
 import sublime_plugin
@@ -22,10 +39,31 @@ HOME = os.path.expanduser('~')
 
 SAVE_EVERY = 50
 
+# How many activations to hold on to while the quick panel is open. If there
+# are more than this, we forget the oldest.
+MAX_DEFERRED_ACTIVATIONS = 100
+
+# How long after hearing a window is about to close to check it has.
+WINDOW_CLOSE_WAIT_MS = 1000
+
 # Utilities.
 
+# Where we get the time from. Replaying a trace swaps this for a clock that
+# follows the trace, see `benchmarks/replay.py`.
+class SystemClock:
+    monotonic = staticmethod(time.monotonic)
+    # After `monotonic`, as this shadows the `time` module in the class body.
+    time = staticmethod(time.time)
+
+clock = SystemClock()
+
 def get_time_seconds():
-    return int(time.time())
+    return int(clock.time())
+
+# For measuring short intervals, where we want precision and don't care about
+# the wall-clock time.
+def get_tick_ms():
+    return int(1000 * clock.monotonic())
 
 # Get a generator that returns `True` every `n` calls, `False` otherwise.
 # Useful to avoid noise of `count +=1; if count % n == 0: (foo; count = 0)`
@@ -41,99 +79,1093 @@ def true_every(n):
 
 SETTINGS_FILE_NAME = 'FrecentHistory.sublime-settings'
 
+# Settings are read all the time, on every activation and panel run, so
+# rather than ask Sublime each time, we keep a snapshot of them that we rebuild
+# when they change.
+SETTINGS_CHANGE_TAG = 'frecent_history'
+
+# Each setting, the type(s) it should have, and a function to check it and turn
+# it into what we want to use, or `None` to use it as is. The lambdas are for
+# names defined further down.
+SETTINGS_SPEC = [
+    ('print_debug', bool, None),
+    ('log_level', str, lambda value: LOG_LEVELS[value]),
+    ('show_file_preview', bool, None),
+    ('file_preview_delay_ms', (int, float), None),
+    ('file_preview_max_bytes', int, None),
+    ('file_preview_mode', str, lambda value: FilePreviewMode(value)),
+    ('file_preview_snippet_lines', int, None),
+    ('activation_dwell_ms', (int, float), None),
+    ('activation_coalesce_ms', (int, float), None),
+    ('max_master_entries', int, None),
+    ('history_path', str, os.path.expanduser),
+    ('history_file_format', str, lambda value: HISTORY_STORES[value]),
+    ('record_trace', bool, None),
+    ('trace_path', str, os.path.expanduser),
+    ('existence_check_timeout_ms', (int, float), None),
+    ('watch_renames', bool, None),
+    ('max_watched_directories', int, None),
+    ('prefetch_related_files', bool, None),
+]
+
+SettingsSnapshot = namedtuple('SettingsSnapshot', [name for name, _, _ in SETTINGS_SPEC])
+
+settings_state = {
+    # A `SettingsSnapshot`, or `None` if the settings changed since we made it.
+    'snapshot': None,
+}
+
+def get_settings():
+    snapshot = settings_state['snapshot']
+    if snapshot is None:
+        snapshot = settings_state['snapshot'] = load_settings_snapshot()
+    return snapshot
+
 # I want to provide reasonable defaults, but the package also should provide
 # default settings, and I don't want to state defaults in two places. So opt to
-# throw an error if we can't find the defaults.
-def get_setting(key):
-    value = sublime.load_settings(SETTINGS_FILE_NAME).get(key)
-    if value is None:
-        raise KeyError(key)
-    else:
-        return value
+# throw an error if we can't find the defaults. Likewise for settings we can't
+# use.
+def load_settings_snapshot():
+    settings = sublime.load_settings(SETTINGS_FILE_NAME)
+    # Sublime keeps callbacks across plugin reloads, so replace rather than add.
+    settings.clear_on_change(SETTINGS_CHANGE_TAG)
+    settings.add_on_change(SETTINGS_CHANGE_TAG, invalidate_settings_snapshot)
+    values = {}
+    for key, expected_type, convert in SETTINGS_SPEC:
+        value = settings.get(key)
+        if value is None:
+            raise KeyError(key)
+        # `bool` is a kind of `int`, but `true` is no number of milliseconds.
+        if not isinstance(value, expected_type) or (isinstance(value, bool) and expected_type is not bool):
+            raise TypeError(f'Setting {key} has unexpected value {value!r}')
+        try:
+            values[key] = value if convert is None else convert(value)
+        except (KeyError, ValueError) as e:
+            raise ValueError(f'Setting {key} has unexpected value {value!r}') from e
+    snapshot = SettingsSnapshot(**values)
+    configure_logging(snapshot)
+    return snapshot
 
-def get_print_debug():
-    return get_setting('print_debug')
+def invalidate_settings_snapshot():
+    settings_state['snapshot'] = None
 
 def get_show_file_preview():
-    return get_setting('show_file_preview')
+    return get_settings().show_file_preview
+
+def get_file_preview_delay_ms():
+    return get_settings().file_preview_delay_ms
+
+def get_file_preview_max_bytes():
+    return get_settings().file_preview_max_bytes
+
+def get_file_preview_mode():
+    return get_settings().file_preview_mode
+
+def get_file_preview_snippet_lines():
+    return get_settings().file_preview_snippet_lines
+
+def get_activation_dwell_ms():
+    return get_settings().activation_dwell_ms
+
+def get_activation_coalesce_ms():
+    return get_settings().activation_coalesce_ms
 
 def get_max_master_entries():
-    return get_setting('max_master_entries')
+    return get_settings().max_master_entries
 
 def get_history_path():
-    return os.path.expanduser(get_setting('history_path'))
+    return get_settings().history_path
+
+def get_record_trace():
+    return get_settings().record_trace
+
+def get_trace_path():
+    return get_settings().trace_path
+
+def get_history_store():
+    return get_settings().history_file_format
+
+def get_existence_check_timeout_ms():
+    return get_settings().existence_check_timeout_ms
+
+def get_watch_renames():
+    return get_settings().watch_renames
+
+def get_max_watched_directories():
+    return get_settings().max_watched_directories
+
+def get_prefetch_related_files():
+    return get_settings().prefetch_related_files
 
 # /Settings.
 
 # Logging.
 
-def log_debug(text):
-    if get_print_debug():
-        print('[FrecentHistory] ' + text)
+# We log through our own `logging` logger, with %-style arguments, so a message
+# below the level we keep is dropped before it's formatted. Messages at the
+# level we keep or above go into a ring buffer, so when something goes wrong we
+# can look at what led up to it without having had debug output on, see
+# `ShowFrecentLogCommand`. With `print_debug` on, we also print everything to
+# the console as we go, and otherwise print nothing, as we always have.
+logger = logging.getLogger('FrecentHistory')
+# The plugin host's root logger is shared with every other plugin.
+logger.propagate = False
+
+# How many of the most recent messages to keep.
+LOG_RING_SIZE = 2000
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+# Keeps the records themselves, and only formats them when asked to show them.
+class RingBufferHandler(logging.Handler):
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def render(self):
+        # Take a copy: records can arrive from the async thread as we format.
+        return ''.join(self.format(record) + '\n' for record in list(self.records))
+
+# Print rather than hold on to `sys.stdout`, which Sublime swaps for its console.
+class ConsoleHandler(logging.Handler):
+
+    def emit(self, record):
+        try:
+            print(self.format(record))
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+log_ring = RingBufferHandler(LOG_RING_SIZE)
+log_ring.setFormatter(logging.Formatter(
+    '%(asctime)s.%(msecs)03d %(levelname)-7s %(threadName)s: %(message)s', '%H:%M:%S',
+))
+log_console = ConsoleHandler()
+log_console.setFormatter(logging.Formatter('[FrecentHistory] %(message)s'))
+# The logger outlives reloads of the plugin, so drop the handlers from the last
+# load before adding ours.
+for handler in list(logger.handlers):
+    logger.removeHandler(handler)
+logger.addHandler(log_ring)
+logger.addHandler(log_console)
+# Until we've read the settings.
+logger.setLevel(logging.INFO)
+log_console.setLevel(logging.ERROR)
+
+# Called with each new settings snapshot.
+def configure_logging(snapshot):
+    ring_level = snapshot.log_level
+    # Errors always go to the console, as they would if we let them raise.
+    console_level = logging.DEBUG if snapshot.print_debug else logging.ERROR
+    log_ring.setLevel(ring_level)
+    log_console.setLevel(console_level)
+    logger.setLevel(min(ring_level, console_level))
 
 # Helper to time execution of chunks of code.
 @contextmanager
 def timed_operation(label):
-    pre = time.time()
+    pre = time.perf_counter()
     try:
         yield
     finally:
-        log_debug(f'"{label}" took {1000 * (time.time() - pre):.0g} milliseconds')
+        duration_ms = 1000 * (time.perf_counter() - pre)
+        record_timing(label, duration_ms)
+        logger.debug('"%s" took %.2f milliseconds', label, duration_ms)
 
 # /Logging.
 
+# Metrics.
+
+# We keep this many of the most recent timings per label to estimate
+# percentiles from, so the memory we use doesn't grow over a long session.
+MAX_TIMING_SAMPLES = 1000
+
+class TimingHistogram:
+
+    def __init__(self):
+        self.count = 0
+        self.max_ms = 0.0
+        self.samples = deque(maxlen=MAX_TIMING_SAMPLES)
+
+    def add(self, duration_ms):
+        self.count += 1
+        self.max_ms = max(self.max_ms, duration_ms)
+        self.samples.append(duration_ms)
+
+    # Nearest-rank percentile over the recent samples.
+    def percentiles(self, qs):
+        samples = sorted(self.samples)
+        return [
+            samples[min(len(samples) - 1, int(q / 100 * len(samples)))] if samples else 0.0
+            for q in qs
+        ]
+
+# Timings and counters are updated from both the main and async threads.
+metrics = {
+    'lock': threading.Lock(),
+    'started': get_time_seconds(),
+    # Map from label to `TimingHistogram`.
+    'timings': defaultdict(TimingHistogram),
+    # Map from counter name to count. For things like events handled, saves,
+    # bytes written and cache hits.
+    'counters': defaultdict(int),
+}
+
+def record_timing(label, duration_ms):
+    with metrics['lock']:
+        metrics['timings'][label].add(duration_ms)
+
+def count_event(name, n=1):
+    with metrics['lock']:
+        metrics['counters'][name] += n
+
+def render_metrics():
+    percentile_qs = [50, 95, 99]
+    with metrics['lock']:
+        label_width = max([len(label) for label in metrics['timings']] + [10])
+        lines = [
+            f'FrecentHistory performance stats, since {time.ctime(metrics["started"])}',
+            '',
+            '{:<{w}} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+                'Timings (ms)', 'count', 'p50', 'p95', 'p99', 'max', w=label_width),
+        ]
+        for label, histogram in sorted(metrics['timings'].items()):
+            lines.append('{:<{w}} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                label,
+                histogram.count,
+                *histogram.percentiles(percentile_qs),
+                histogram.max_ms,
+                w=label_width,
+            ))
+        counters = dict(metrics['counters'])
+
+    # Some caches count for themselves.
+    for cache_name, cache_function in [
+            ('snippet_cache', read_file_snippet),
+            ('path_shortener_cache', get_path_shortener),
+            ('subtitle_templates_cache', get_subtitle_templates),
+    ]:
+        cache_info = cache_function.cache_info()
+        counters[f'{cache_name}_hits'] = cache_info.hits
+        counters[f'{cache_name}_misses'] = cache_info.misses
+
+    lines += ['', 'Counters']
+    counter_width = max(len(name) for name in counters)
+    for name, count in sorted(counters.items()):
+        lines.append(f'{name:<{counter_width}} {count:>12}')
+    return '\n'.join(lines) + '\n'
+
+# Show some text in a new scratch view, for reports the user asks for.
+def show_report(window, name, text):
+    view = window.new_file()
+    view.set_name(name)
+    view.set_scratch(True)
+    view.run_command('append', {'characters': text})
+    view.set_read_only(True)
+
+# /Metrics.
+
+# Profiling.
+
+# When a user tells us the plugin is slow, we want to see why on their
+# machine. So on request we profile the next few panel runs and activation
+# batches, and write what we find next to the history file.
+
+# How many frames of traceback to keep per allocation.
+TRACEMALLOC_FRAMES = 10
+# How many of the biggest allocation sites to report.
+TOP_ALLOCATIONS = 30
+
+profiling = {
+    'lock': threading.Lock(),
+    # How many more operations to profile.
+    'remaining': 0,
+    'use_cprofile': False,
+    'use_tracemalloc': False,
+    # Whether we started tracing allocations, rather than someone else, so
+    # it's up to us to stop.
+    'started_tracemalloc': False,
+    # `pstats.Stats` accumulated over the operations profiled so far.
+    'stats': None,
+}
+
+def start_profile_capture(n_operations, use_cprofile, use_tracemalloc):
+    with profiling['lock']:
+        profiling['remaining'] = n_operations
+        profiling['use_cprofile'] = use_cprofile
+        profiling['use_tracemalloc'] = use_tracemalloc
+        profiling['stats'] = None
+        # A capture might be running already, started with other options.
+        if profiling['started_tracemalloc']:
+            if use_tracemalloc:
+                tracemalloc.clear_traces()
+            else:
+                stop_tracemalloc()
+        elif use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            profiling['started_tracemalloc'] = True
+    logger.info('Profiling the next %d operations', n_operations)
+
+# Wrap an operation we might want to profile. This is a no-op unless a capture
+# is running.
+@contextmanager
+def profiled_operation():
+    if profiling['remaining'] <= 0:
+        yield
+        return
+
+    profile = cProfile.Profile() if profiling['use_cprofile'] else None
+    if profile is not None:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+        with profiling['lock']:
+            # Another thread might have finished the capture meanwhile.
+            if profiling['remaining'] > 0:
+                if profile is not None:
+                    if profiling['stats'] is None:
+                        profiling['stats'] = pstats.Stats(profile)
+                    else:
+                        profiling['stats'].add(profile)
+                profiling['remaining'] -= 1
+                if profiling['remaining'] == 0:
+                    finish_profile_capture()
+
+# Called with the profiling lock held.
+def finish_profile_capture():
+    stem = os.path.join(
+        os.path.dirname(get_history_path()),
+        time.strftime('frecent_history-profile-%Y%m%d-%H%M%S'),
+    )
+    written_paths = []
+    if profiling['stats'] is not None:
+        profiling['stats'].dump_stats(f'{stem}.pstats')
+        written_paths.append(f'{stem}.pstats')
+        profiling['stats'] = None
+    if profiling['use_tracemalloc'] and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        if profiling['started_tracemalloc']:
+            stop_tracemalloc()
+        with open(f'{stem}-allocations.txt', 'w') as f:
+            f.write(render_top_allocations(snapshot))
+        written_paths.append(f'{stem}-allocations.txt')
+    message = f'Wrote profile to {", ".join(written_paths)}'
+    logger.info('%s', message)
+    sublime.status_message(f'FrecentHistory: {message}')
+
+# Called with the profiling lock held.
+def stop_tracemalloc():
+    tracemalloc.stop()
+    profiling['started_tracemalloc'] = False
+
+def render_top_allocations(snapshot):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    stats = snapshot.statistics('traceback')
+    out = io.StringIO()
+    total = sum(stat.size for stat in stats)
+    out.write(f'Total allocated size: {total / 1024:.1f} KiB\n')
+    for index, stat in enumerate(stats[:TOP_ALLOCATIONS]):
+        out.write(f'\n#{index + 1}: {stat.size / 1024:.1f} KiB in {stat.count} blocks\n')
+        for line in stat.traceback.format():
+            out.write(line + '\n')
+    return out.getvalue()
+
+# /Profiling.
+
+# Tracing.
+
+# To measure changes against real usage rather than synthetic histories, we can
+# record what the user does to a trace file, and replay it later with
+# `benchmarks/replay.py`. Each line is a compact JSON array of the time, a
+# letter for the kind of event, the window-ID, and then:
+# - 'w', folders: the first event we've seen from this window.
+# - 'a', path: a view was activated. The path is `null` for unsaved views.
+# - 'p', use_master, open_status_filter, related: the panel was shown.
+# - 's', index, path: an entry was picked, or index is -1 if cancelled.
+
+tracing = {
+    'lock': threading.Lock(),
+    'file': None,
+    'path': None,
+    'seen_window_ids': set(),
+}
+
+def trace_event(window, kind, *fields):
+    if not get_record_trace():
+        # It's just been turned off.
+        if tracing['file'] is not None:
+            stop_tracing()
+        return
+    if window is None:
+        return
+    trace_path = get_trace_path()
+    with tracing['lock']:
+        if tracing['path'] != trace_path:
+            if tracing['file'] is not None:
+                tracing['file'].close()
+            # Line-buffered, so we lose at most the event in hand if Sublime
+            # goes away.
+            tracing['file'] = open(trace_path, 'a', buffering=1)
+            tracing['path'] = trace_path
+            tracing['seen_window_ids'].clear()
+        t = round(clock.time(), 3)
+        if window.id() not in tracing['seen_window_ids']:
+            tracing['seen_window_ids'].add(window.id())
+            write_trace_line([t, 'w', window.id(), window.folders()])
+        write_trace_line([t, kind, window.id(), *fields])
+
+def write_trace_line(event):
+    tracing['file'].write(json.dumps(event, separators=(',', ':')) + '\n')
+
+def stop_tracing():
+    with tracing['lock']:
+        if tracing['file'] is not None:
+            tracing['file'].close()
+        tracing['file'] = None
+        tracing['path'] = None
+        tracing['seen_window_ids'].clear()
+
+# /Tracing.
+
+# Tasks.
+
+# Some operations scale with the whole history, like finding the entries under
+# a window's folders, and on a big history they'd hold up the thread they run
+# on, and anyone waiting on the state lock, for a noticeable while. So we write
+# them as generators that yield every so often, and run them a slice at a time
+# on the async thread, a few milliseconds per slice, between everything else
+# that runs there. A step must not hold the state lock across a `yield`.
+
+# How long a slice may run for before we let something else have a go. A step
+# that started within the budget runs to its end, so keep steps short.
+TASK_SLICE_MS = 5
+
+class TaskPriority(Enum):
+    # Someone's waiting on it, like a panel waiting for its window history.
+    HIGH = 0
+    NORMAL = 1
+    # Housekeeping nobody's waiting on.
+    LOW = 2
+
+class Task:
+
+    def __init__(self, name, steps, priority):
+        self.name = name
+        self.steps = steps
+        self.priority = priority
+        self.cancelled = False
+        # Done once the task finishes, with the exception if it failed, or
+        # cancelled if it was cancelled before it finished.
+        self.future = Future()
+
+    # Safe from any thread. The task stops before its next step.
+    def cancel(self):
+        self.cancelled = True
+
+tasks = {
+    'lock': threading.Lock(),
+    # Heap of (priority, sequence number, task), so tasks run highest priority
+    # first, and in the order they started within a priority.
+    'queue': [],
+    'sequence': itertools.count(),
+    'slice_scheduled': False,
+}
+
+def start_task(name, steps, priority=TaskPriority.NORMAL):
+    task = Task(name, steps, priority)
+    with tasks['lock']:
+        heapq.heappush(tasks['queue'], (priority.value, next(tasks['sequence']), task))
+        schedule_task_slice()
+    return task
+
+# Call with the tasks lock held.
+def schedule_task_slice():
+    if tasks['queue'] and not tasks['slice_scheduled']:
+        tasks['slice_scheduled'] = True
+        sublime.set_timeout_async(run_task_slice, 0)
+
+# Run a step at a time from the highest-priority task, so a task started
+# during the slice can jump in ahead of the rest.
+# The budget is in real time, not `clock` time, which a replay might simulate.
+def run_task_slice():
+    pre = time.perf_counter()
+    with tasks['lock']:
+        tasks['slice_scheduled'] = False
+    while 1000 * (time.perf_counter() - pre) < TASK_SLICE_MS:
+        with tasks['lock']:
+            if not tasks['queue']:
+                break
+            queue_entry = heapq.heappop(tasks['queue'])
+        task = queue_entry[2]
+        if task.cancelled:
+            task.steps.close()
+            task.future.cancel()
+            count_event('tasks_cancelled')
+            continue
+        try:
+            next(task.steps)
+        except StopIteration:
+            task.future.set_result(None)
+            count_event('tasks_finished')
+            continue
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Task "%s" failed', task.name)
+            task.future.set_exception(e)
+            continue
+        with tasks['lock']:
+            heapq.heappush(tasks['queue'], queue_entry)
+    record_timing('Task slice', 1000 * (time.perf_counter() - pre))
+    count_event('task_slices')
+    with tasks['lock']:
+        schedule_task_slice()
+
+# Run a task's steps straight through, for callers that need it done now.
+def run_steps(steps):
+    for _ in steps:
+        pass
+
+# /Tasks.
+
+# Paths.
+
+# History paths overlap a lot: the same home directory, project roots and deep
+# source trees turn up again and again. So rather than keep a full string per
+# path, we keep a tree of directories, and refer to a path by a key made of
+# its directory's ID in the tree and its basename. We only rebuild the full
+# string where we need it, like to show or open the path. The tree also makes
+# it cheap to find the paths under a folder.
+#
+# Keys are `bytes`: the directory ID in a fixed-width prefix, then the UTF-8
+# basename. That's one small object per path, where a tuple or an int ID would
+# cost another object besides the basename.
+#
+# Directories are never removed, so IDs stay valid, and lookups don't need the
+# lock: a directory is fully set up before we link it into the tree.
+class PathTable:
+
+    ROOT = 0
+    ID_BYTES = 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Map from directory-ID to the ID of its parent, and to its last
+        # component.
+        self.parents = array('l', [-1])
+        self.names = ['']
+        # Map from directory-ID to a dict from child name to child directory-ID,
+        # for directories with children.
+        self.children = {}
+        # Many paths share a directory, so remember recent directories both
+        # ways. IDs never change, so neither cache can go stale.
+        self.get_directory_path = functools.lru_cache(maxsize=4096)(self.build_directory_path)
+        self.intern_directory = functools.lru_cache(maxsize=4096)(self.add_directory)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, path):
+        directory, _, name = path.rpartition(os.sep)
+        return self.make_key(self.intern_directory(directory), name)
+
+    # Get the key for a path, or `None` if we've never seen its directory.
+    def lookup(self, path):
+        directory, _, name = path.rpartition(os.sep)
+        directory_id = self.lookup_directory(directory)
+        return None if directory_id is None else self.make_key(directory_id, name)
+
+    def make_key(self, directory_id, name):
+        return directory_id.to_bytes(self.ID_BYTES, 'big') + name.encode('utf-8', 'surrogateescape')
+
+    def get_directory_id(self, key):
+        return int.from_bytes(key[:self.ID_BYTES], 'big')
+
+    # The key prefixes of the paths in a directory or anywhere below it.
+    def get_subtree_prefixes(self, directory_id):
+        return {node_id.to_bytes(self.ID_BYTES, 'big') for node_id in self.get_subtree(directory_id)}
+
+    def get_path(self, key):
+        return (
+            self.get_directory_path(self.get_directory_id(key))
+            + os.sep
+            + key[self.ID_BYTES:].decode('utf-8', 'surrogateescape')
+        )
+
+    def add_directory(self, directory):
+        directory_id = self.lookup_directory(directory)
+        if directory_id is not None:
+            return directory_id
+        with self.lock:
+            node_id = self.ROOT
+            for name in directory.split(os.sep):
+                node_children = self.children.get(node_id)
+                if node_children is None:
+                    node_children = self.children[node_id] = {}
+                child_id = node_children.get(name)
+                if child_id is None:
+                    child_id = len(self.names)
+                    self.parents.append(node_id)
+                    self.names.append(name)
+                    node_children[name] = child_id
+                node_id = child_id
+            return node_id
+
+    def lookup_directory(self, directory):
+        node_id = self.ROOT
+        for name in directory.split(os.sep):
+            node_children = self.children.get(node_id)
+            if node_children is None:
+                return None
+            node_id = node_children.get(name)
+            if node_id is None:
+                return None
+        return node_id
+
+    def build_directory_path(self, directory_id):
+        parent_id = self.parents[directory_id]
+        if parent_id == self.ROOT:
+            return self.names[directory_id]
+        else:
+            return self.get_directory_path(parent_id) + os.sep + self.names[directory_id]
+
+    # The IDs of a directory and all the directories below it. We take the lock
+    # here since a writer could grow a dict while we walk it.
+    def get_subtree(self, directory_id):
+        with self.lock:
+            subtree = [directory_id]
+            for node_id in subtree:
+                subtree.extend(self.children.get(node_id, {}).values())
+            return subtree
+
+path_table = PathTable()
+
+# /Paths.
+
+# Filesystem.
+
+# Checking a path exists is usually a quick `stat`, but on a network mount that
+# has gone away (NFS, sshfs) it can hang for minutes, and take the panel or the
+# async thread with it. So we check on a few worker threads, and give up after
+# a timeout. A mount that timed out is left alone for a while, and paths on it
+# count as neither there nor gone, so we don't block on it or forget its paths.
+
+# Where we stat paths and find mount points. Benchmarks swap this for a stand-in
+# that can be slow or pretend paths exist, see `benchmarks/`.
+# Filesystem types whose files live on another machine. They can hang when it
+# goes away, and inotify doesn't hear about changes made from elsewhere.
+REMOTE_FILESYSTEM_TYPES = frozenset([
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph',
+    'glusterfs', 'lustre', 'davfs', 'fuse.sshfs', 'fuse.rclone', 'fuse.s3fs',
+    'fuse.gcsfuse', 'fuse.glusterfs',
+])
+
+class LocalFilesystem:
+    stat = staticmethod(os.stat)
+
+    @staticmethod
+    def get_mounts():
+        # Linux lists mounts here, escaping spaces and such in octal. Elsewhere
+        # we go by drive, see `get_mount_point`.
+        try:
+            with open('/proc/self/mounts', 'rb') as f:
+                return [
+                    (
+                        os.fsdecode(re.sub(
+                            rb'\\([0-7]{3})',
+                            lambda match: bytes([int(match.group(1), 8)]),
+                            fields[1],
+                        )),
+                        os.fsdecode(fields[2]),
+                    )
+                    for fields in map(bytes.split, f) if len(fields) > 2
+                ]
+        except OSError:
+            return []
+
+    def get_mount_points(self):
+        return [mount_point for mount_point, _ in self.get_mounts()]
+
+    def get_remote_mount_points(self):
+        return [
+            mount_point
+            for mount_point, filesystem_type in self.get_mounts()
+            if filesystem_type in REMOTE_FILESYSTEM_TYPES
+        ]
+
+filesystem = LocalFilesystem()
+
+class PathExistence(Enum):
+    EXISTS = 'exists'
+    MISSING = 'missing'
+    # We couldn't tell in time.
+    UNKNOWN = 'unknown'
+
+# How many stats can be in flight at once. A stat on a hung mount can hold on to
+# a worker for as long as the mount is hung, so we don't send another to that
+# mount until it returns, see `check_path_exists`.
+EXISTENCE_CHECK_WORKERS = 4
+
+# How often to re-read the list of mount points.
+MOUNT_POINTS_MAX_AGE_MS = 60 * 1000
+
+# How long to leave a mount alone after it times out. Doubles each time it
+# times out again, up to the maximum.
+MOUNT_RETRY_MIN_MS = 5 * 1000
+MOUNT_RETRY_MAX_MS = 5 * 60 * 1000
+
+filesystem_state = {
+    'lock': threading.Lock(),
+    'executor': ThreadPoolExecutor(
+        max_workers=EXISTENCE_CHECK_WORKERS,
+        thread_name_prefix='FrecentHistory-stat',
+    ),
+    # Mount points, longest first so the first that matches a path is its own.
+    'mount_points': [],
+    'mount_points_tick_ms': None,
+    # The set of those that are remote, see `REMOTE_FILESYSTEM_TYPES`.
+    'remote_mount_points': frozenset(),
+    # Map from mount point to (tick when we can try it again, how long we last
+    # left it alone).
+    'unhealthy_mounts': {},
+    # Map from mount point to the future of a stat on it that timed out and
+    # hasn't returned yet, still holding on to a worker.
+    'hung_stats': {},
+}
+
+def get_mount_point(path):
+    tick_ms = get_tick_ms()
+    with filesystem_state['lock']:
+        if (filesystem_state['mount_points_tick_ms'] is None
+                or tick_ms - filesystem_state['mount_points_tick_ms'] > MOUNT_POINTS_MAX_AGE_MS):
+            filesystem_state['mount_points'] = sorted(
+                filesystem.get_mount_points(), key=len, reverse=True)
+            filesystem_state['remote_mount_points'] = frozenset(filesystem.get_remote_mount_points())
+            filesystem_state['mount_points_tick_ms'] = tick_ms
+        mount_points = filesystem_state['mount_points']
+    for mount_point in mount_points:
+        if (path == mount_point
+                or path.startswith(mount_point if mount_point.endswith(os.sep) else mount_point + os.sep)):
+            return mount_point
+    return os.path.splitdrive(path)[0] or os.sep
+
+# Whether the mount a path is on is local, and has answered the last stat we
+# sent it, so we can expect calls on the path to return.
+def is_on_healthy_local_mount(path):
+    mount_point = get_mount_point(path)
+    with filesystem_state['lock']:
+        return (
+            mount_point not in filesystem_state['remote_mount_points']
+            and mount_point not in filesystem_state['unhealthy_mounts']
+            and mount_point not in filesystem_state['hung_stats']
+        )
+
+def check_path_exists(path):
+    count_event('existence_checks')
+    mount_point = get_mount_point(path)
+    tick_ms = get_tick_ms()
+    with filesystem_state['lock']:
+        retry_tick_ms, backoff_ms = filesystem_state['unhealthy_mounts'].get(mount_point, (None, 0))
+    if retry_tick_ms is not None and tick_ms < retry_tick_ms:
+        count_event('existence_checks_skipped')
+        return PathExistence.UNKNOWN
+    # Even once we can try it again, if the last stat we sent is still stuck
+    # then so would this one be. Sending it anyway would tie up another worker
+    # each time we retry, until none were left for the healthy mounts.
+    with filesystem_state['lock']:
+        hung_future = filesystem_state['hung_stats'].get(mount_point)
+        if hung_future is not None and hung_future.done():
+            del filesystem_state['hung_stats'][mount_point]
+            hung_future = None
+    if hung_future is not None:
+        count_event('existence_checks_skipped')
+        return PathExistence.UNKNOWN
+
+    future = filesystem_state['executor'].submit(filesystem.stat, path)
+    try:
+        future.result(timeout=get_existence_check_timeout_ms() / 1000)
+    except FutureTimeoutError:
+        backoff_ms = min(MOUNT_RETRY_MAX_MS, max(MOUNT_RETRY_MIN_MS, 2 * backoff_ms))
+        logger.warning('Checking %s timed out, leaving %s alone for %d ms', path, mount_point, backoff_ms)
+        count_event('existence_checks_timed_out')
+        with filesystem_state['lock']:
+            filesystem_state['unhealthy_mounts'][mount_point] = (get_tick_ms() + backoff_ms, backoff_ms)
+            filesystem_state['hung_stats'][mount_point] = future
+        return PathExistence.UNKNOWN
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        existence = PathExistence.MISSING
+    except OSError as e:
+        # Say, permission denied, or a stale NFS handle. The path might well
+        # still be there.
+        logger.info('Could not check %s: %s', path, e)
+        existence = PathExistence.UNKNOWN
+    else:
+        existence = PathExistence.EXISTS
+    if retry_tick_ms is not None:
+        logger.info('%s is responding again', mount_point)
+        with filesystem_state['lock']:
+            filesystem_state['unhealthy_mounts'].pop(mount_point, None)
+    return existence
+
+# /Filesystem.
+
 # Global state.
 
-def new_history_entry():
-    now = get_time_seconds()
-    return dict(added=now, last_seen=now, inserts=0)
+# There can be a lot of these, so keep them small: with slots rather than a
+# dict per entry. Remember entries in the state are never mutated, see
+# `HistoryState`.
+class HistoryEntry:
+    __slots__ = ('added', 'last_seen', 'inserts')
 
-# Global state to coordinate the event-listener tracking views, and the window
-# commands. Maybe you could write this to avoid mutable global state, but it
-# might turn out to be more difficult than you expect.
-global_state = {
-    # Global dict mapping path to path attributes.
-    # In general this structure is a 'history'.
-    'master_history': defaultdict(new_history_entry),
+    def __init__(self, added, last_seen, inserts):
+        self.added = added
+        self.last_seen = last_seen
+        self.inserts = inserts
+
+    def seen(self, now):
+        return HistoryEntry(added=self.added, last_seen=now, inserts=self.inserts + 1)
+
+    def to_json(self):
+        return dict(added=self.added, last_seen=self.last_seen, inserts=self.inserts)
+
+def new_history_entry(now):
+    return HistoryEntry(added=now, last_seen=now, inserts=0)
 
-    # Map from window-ID to 'history' relevant to that window. In practice the
-    # values are shared objects with the master list, and maybe across
-    # windows.
-    'window_histories': defaultdict(dict),
+HISTORY_ENTRY_KEYS = frozenset(HistoryEntry.__slots__)
 
+# Hooks so `json` builds entries directly as it parses, and can write them.
+def decode_history_entry(obj):
+    if obj.keys() == HISTORY_ENTRY_KEYS:
+        return HistoryEntry(**obj)
+    else:
+        return obj
+
+def encode_history_entry(obj):
+    if isinstance(obj, HistoryEntry):
+        return obj.to_json()
+    else:
+        raise TypeError(f'Cannot encode {type(obj).__name__} as JSON')
+
+# The history is written from the async thread, as views get activated, and
+# read from the main thread, when we show the panel. So writers make their
+# changes while holding a lock, and readers work from an immutable snapshot of
+# the state, so they never see a half-made change or hold up a writer for
+# longer than it takes to copy a few dicts.
+#
+# To make snapshots cheap, a history entry is never mutated once it's in the
+# state: writers replace it with an updated copy instead. A snapshot can then
+# share entries with the live state. It shares the master history dict itself
+# too, and the next writer copies that before changing it, so readers never
+# pay for the copy. Window path sets are frozen for the windows a snapshot is
+# asked for, and the frozen copy kept until that window's set changes.
+class HistoryState:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+        # Dict mapping path key (see `PathTable`) to path attributes.
+        # In general this structure is a 'history'.
+        self.master_history = {}
+
+        # Map from window-ID to the set of path keys relevant to that window.
+        # The attributes for those paths live in the master history.
+        self.window_paths = defaultdict(set)
+        # Frozen copies of those sets for snapshots, until the set changes.
+        # Call `window_paths_changed` after changing one.
+        self.frozen_window_paths = {}
+
+        # The reverse of `window_paths`: map from path key to a tuple of the
+        # IDs of the windows it's in, so we can remove a path without looking
+        # through every window. A path is in few windows, and a tuple is a lot
+        # smaller than a set.
+        self.path_windows = {}
+
+        # If we notice a path no longer exists, we can put its key here to
+        # remove it from the history later, to avoid slowing down operations by
+        # doing it at the time. Emptied each time we remove them.
+        self.paths_to_remove = set()
+
+        # Map from path key to when we removed it. Saved along with the
+        # history, so we don't bring a removed path back from an older copy of
+        # the file, see `apply_tombstones`.
+        self.tombstones = {}
+
+        # While the saved history loads, a list of the (path key, time) of each
+        # path seen, to apply on top of the saved entries once they're in.
+        # `None` when no load is in progress.
+        self.seen_during_load = None
+
+        # Keys of the paths whose entries changed or went away since we last
+        # saved. Entries are shared with snapshots and never mutated, so we
+        # keep this here rather than a flag on each entry.
+        self.dirty_paths = set()
+
+        # When the history file can take more changes on the end, see
+        # `RankedHistoryStore`, a tuple of its path and how many changes it
+        # has had since it was last written in full. `None` otherwise.
+        self.appendable_file = None
+
+        # We want to save every `n` operations. We use this generator to track
+        # how many operations we've done.
+        self.save_cycle = true_every(SAVE_EVERY)
+
+        # Bumped on every change, so we know when a snapshot is stale.
+        self.version = 0
+        self.latest_snapshot = None
+        # Whether the latest snapshot has our `master_history`, so we have to
+        # copy it before changing it.
+        self.master_history_shared = False
+
+    # Use as `with history_state.writing():` around any change to the state,
+    # and don't take a snapshot inside it.
+    @contextmanager
+    def writing(self):
+        with self.lock:
+            if self.master_history_shared:
+                self.master_history = dict(self.master_history)
+                self.master_history_shared = False
+            try:
+                yield self
+            finally:
+                self.version += 1
+
+    # Snapshots are published lazily: the first reader after a change makes
+    # one, and later readers share it until the next change. Pass the IDs of
+    # the windows whose histories you want from it.
+    def snapshot(self, window_ids=()):
+        snapshot = self.latest_snapshot
+        if (snapshot is not None
+                and snapshot.version == self.version
+                and all(window_id in snapshot.window_paths for window_id in window_ids)):
+            count_event('snapshot_cache_hits')
+            return snapshot
+        count_event('snapshot_cache_misses')
+        with self.lock:
+            snapshot = self.latest_snapshot
+            if snapshot is None or snapshot.version != self.version:
+                snapshot = self.latest_snapshot = HistorySnapshot(self.version, self.master_history)
+                self.master_history_shared = True
+            # Still the same version, so we can add windows to it.
+            for window_id in window_ids:
+                if window_id not in snapshot.window_paths:
+                    frozen_paths = self.frozen_window_paths.get(window_id)
+                    if frozen_paths is None:
+                        frozen_paths = frozenset(self.window_paths.get(window_id, ()))
+                        self.frozen_window_paths[window_id] = frozen_paths
+                    snapshot.window_paths[window_id] = frozen_paths
+            return snapshot
+
+    # Call while `writing()`.
+    def window_paths_changed(self, window_id):
+        self.frozen_window_paths.pop(window_id, None)
+
+    # Call while `writing()`.
+    def add_window_path(self, window_id, path_key):
+        window_paths = self.window_paths[window_id]
+        if path_key not in window_paths:
+            window_paths.add(path_key)
+            self.window_paths_changed(window_id)
+        window_ids = self.path_windows.get(path_key, ())
+        if window_id not in window_ids:
+            self.path_windows[path_key] = window_ids + (window_id,)
+
+class HistorySnapshot:
+
+    def __init__(self, version, master_history):
+        self.version = version
+        self.master_history = MappingProxyType(master_history)
+        # Map from window ID to its frozen set of path keys, for the windows
+        # asked for so far. Only `HistoryState.snapshot` adds to this.
+        self.window_paths = {}
+
+    def get_window_history(self, window_id):
+        master_history = self.master_history
+        return {
+            path_key: master_history[path_key]
+            for path_key in self.window_paths.get(window_id, ())
+            if path_key in master_history
+        }
+
+history_state = HistoryState()
+
+# How many activation drains between checks for closed windows.
+WINDOW_CHECK_EVERY = 20
+
+# Global state to coordinate the event-listener tracking views, and the window
+# commands, apart from the history itself.
+global_state = {
     # Whether the window quick-panel is open. Don't mutate the state while it's
     # open, or you might crash Sublime.
     'active': False,
 
-    # If we notice a path no longer exists, we can put it here to remove from
-    # the history later, to avoid slowing down operations by doing it at the
-    # time.
-    'paths_to_remove': set(),
+    # Activations waiting to be drained, oldest first. See `queue_activation`.
+    'activation_queue': deque(),
+    'activation_drain_scheduled': False,
 
-    # We want to save every `n` operations. We use this generator to track how
-    # many operations we've done.
-    'save_cycle': true_every(SAVE_EVERY),
+    # Map from (window-ID, path) to the tick when we last recorded that
+    # activation, so we can collapse repeats.
+    'recent_activations': {},
+
+    # Activations that happened while the panel was open, as
+    # (window, path, time) tuples, to record once it closes.
+    'deferred_activations': deque(maxlen=MAX_DEFERRED_ACTIVATIONS),
+
+    # (window-ID, path) pairs we opened a preview view for since the panel was
+    # last shown, so we can tell the user didn't activate them themselves.
+    'previewed_paths': set(),
+
+    # When to check for closed windows we missed, see `forget_closed_windows`.
+    'window_check_cycle': true_every(WINDOW_CHECK_EVERY),
+
+    # Map from window-ID to the `Task` populating that window's history from
+    # the master history, see `start_window_population`.
+    'window_populations': {},
+
+    # Map from window-ID to the key of the path we last recorded an activation
+    # of in that window, see `record_transition`.
+    'last_recorded_paths': {},
 }
 
-# Just a wee helper for a common operation, no grand principles at play.
-def get_window_history(window):
-    return global_state['window_histories'][window.id()]
+# Serializes writes to the history file, which can happen from either thread.
+save_lock = threading.Lock()
 
 def record_seen_path_in_window(window, path, now):
-    window_history = get_window_history(window)
+    logger.debug('Adding/Updating %s', path)
+    path_key = path_table.intern(path)
+    with history_state.writing() as state:
+        # Add/update entry in master history.
+        entry = state.master_history.get(path_key) or new_history_entry(now)
+        state.master_history[path_key] = entry.seen(now)
+
+        # Add entry to window history if necessary.
+        state.add_window_path(window.id(), path_key)
+
+        # We've seen it, so it's not gone after all.
+        state.tombstones.pop(path_key, None)
 
-    # Add/update entry in master history.
-    entry = global_state['master_history'][path]
-    log_debug(f'Adding/Updating {path}')
-    entry['last_seen'] = now
-    entry['inserts'] += 1
+        state.dirty_paths.add(path_key)
 
-    # Add entry to window history if necessary.
-    window_history[path] = entry
+        if state.seen_during_load is not None:
+            state.seen_during_load.append((path_key, now))
 
-    if next(global_state['save_cycle']):
-        log_debug('Saving...')
+        should_save = next(state.save_cycle)
+
+    if should_save:
+        logger.debug('Saving...')
         save_master_history_to_file(get_history_path(), now=now)
+        refresh_watched_directories()
 
 # Merge one source of history into another. Our implementation is optimised for
 # the case where the history-to-merge is smaller than the
@@ -142,55 +1174,391 @@ def merge_histories(mergee_history, merger_history):
     for path, merger_entry in merger_history.items():
         if path in mergee_history:
             mergee_entry = mergee_history[path]
-            mergee_entry['last_seen'] = max(mergee_entry['last_seen'], merger_entry['last_seen'])
-            mergee_entry['inserts'] = max(mergee_entry['inserts'], merger_entry['inserts'])
-            mergee_entry['added'] = min(mergee_entry['added'], merger_entry['added'])
+            mergee_history[path] = HistoryEntry(
+                added=min(mergee_entry.added, merger_entry.added),
+                last_seen=max(mergee_entry.last_seen, merger_entry.last_seen),
+                inserts=max(mergee_entry.inserts, merger_entry.inserts),
+            )
         else:
             mergee_history[path] = merger_entry
 
-def load_and_populate_state_from_file(store_path):
+# Loading and parsing a big history takes a while, so we start as soon as the
+# plugin loads, on a thread of its own, rather than make the first panel wait.
+# See `plugin_loaded`.
+history_load = {
+    'lock': threading.Lock(),
+    # A `concurrent.futures.Future` for the load, once it's started.
+    'future': None,
+    # Another that's done once we have the first chunk of the history, enough
+    # for a useful panel. With the ranked format that's long before the rest.
+    'first_chunk': None,
+}
+
+def start_history_load():
+    with history_load['lock']:
+        if history_load['future'] is not None:
+            return history_load['future']
+        with history_state.writing() as state:
+            state.seen_during_load = []
+        history_load['first_chunk'] = Future()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='FrecentHistory-load')
+        history_load['future'] = executor.submit(load_history_in_background, get_history_path())
+        executor.shutdown(wait=False)
+        return history_load['future']
+
+# Whether the saved history is in, or we're not loading it at all.
+def is_history_loaded():
+    future = history_load['future']
+    return future is None or future.done()
+
+def load_history_in_background(store_path):
+    try:
+        with timed_operation('Load state from file'):
+            load_and_populate_state_from_file(store_path, on_first_chunk=publish_first_chunk)
+    except Exception:
+        # Nothing looks at the future's exception, so say so here, say for a
+        # corrupt file.
+        logger.exception('Could not load history from %s', store_path)
+        raise
+    finally:
+        # If the load failed, the paths seen are in the state already.
+        with history_state.writing() as state:
+            state.seen_during_load = None
+        if not history_load['first_chunk'].done():
+            history_load['first_chunk'].set_result(None)
+    # Now we know which directories are worth watching.
+    refresh_watched_directories()
+
+# Give the windows what we have so far. It's only a chunk, so this is quick.
+def publish_first_chunk():
+    with timed_operation('Populate window histories from first chunk'):
+        for window in sublime.windows():
+            populate_window_history_from_master(window)
+    history_load['first_chunk'].set_result(None)
+
+def load_and_populate_state_from_file(store_path, on_first_chunk=None):
     # First we load the master list from the stored file.
     with timed_operation('Load master history'):
-        load_master_history_from_file(store_path)
+        load_master_history_from_file(store_path, on_first_chunk)
     # Then we populate the window histories.
     with timed_operation('Populate window histories'):
         for window in sublime.windows():
             # There are two sources of data to populate:
             # - The master list, which might have entries for files relevant to
-            #   our window.
+            #   our window. There can be a lot of it, so that's a task.
             # - The already-open files in the window.
-            populate_window_history_from_master(window)
+            start_window_population(window, TaskPriority.NORMAL)
             populate_window_history_from_views(window)
 
-def load_master_history_from_file(store_path):
-    log_debug(f'Loading from {store_path}')
+# The history file used to be just the dict of entries. Now it's a dict with
+# the version of the format, the entries, and the tombstones of removed paths.
+HISTORY_FILE_VERSION = 2
+
+# How long to remember a path we removed. By then we'll have saved without it
+# many times over.
+TOMBSTONE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Split the contents of a history file into entries and tombstones, for either
+# version of the format.
+def parse_history_file(stored):
+    if stored.get('version') == HISTORY_FILE_VERSION:
+        return stored['entries'], stored['tombstones']
+    else:
+        return stored, {}
+
+# The whole history as one JSON object, see `parse_history_file`. Easy to read
+# and edit, but we have to parse all of it before we can use any of it.
+class JsonHistoryStore:
+
+    supports_append = False
+
+    def read_chunks(self, f):
+        yield parse_history_file(json.load(f, object_hook=decode_history_entry))
+
+    def write(self, f, entries, tombstones):
+        json.dump(
+            {
+                'version': HISTORY_FILE_VERSION,
+                'entries': entries,
+                'tombstones': tombstones,
+            },
+            f,
+            allow_nan=False,
+            sort_keys=True,
+            indent=2,
+            default=encode_history_entry,
+        )
+
+RANKED_FILE_FORMAT = 'frecent_history_ranked'
+RANKED_FILE_VERSION = 1
+
+# How many entries to read before we publish what we have, and how many at a
+# time after that.
+FIRST_CHUNK_ENTRIES = 1000
+LOAD_CHUNK_ENTRIES = 10000
+
+# One JSON value per line: a header with the format, version and counts, then
+# the tombstones as `[path, removed_at]`, then the entries as `[path, added,
+# last_seen, inserts]`, highest score first. So the first few lines hold the
+# entries the panel shows first, and we can use them before reading the rest.
+#
+# Saves between full writes just append the entries that changed, and
+# tombstones for those removed, in the same shapes. Where a path has several
+# lines, the newest entry or tombstone wins, as in `merge_stored_history`.
+class RankedHistoryStore:
+
+    supports_append = True
+
+    def read_chunks(self, f):
+        header = json.loads(f.readline())
+        tombstones = dict(
+            json.loads(line) for line in itertools.islice(f, header['tombstones'])
+        )
+        n_entries_left = header['entries']
+        chunk_size = FIRST_CHUNK_ENTRIES
+        while n_entries_left > 0:
+            lines = list(itertools.islice(f, min(chunk_size, n_entries_left)))
+            if not lines:
+                break
+            n_entries_left -= len(lines)
+            # One parse per chunk is much quicker than one per line.
+            entries = {
+                path: HistoryEntry(added=added, last_seen=last_seen, inserts=inserts)
+                for path, added, last_seen, inserts in self.parse_lines(lines)
+            }
+            yield entries, tombstones
+            tombstones = {}
+            chunk_size = LOAD_CHUNK_ENTRIES
+
+        entries = {}
+        for change in self.parse_lines(list(f)):
+            if len(change) == 2:
+                path, removed_at = change
+                tombstones[path] = max(removed_at, tombstones.get(path, removed_at))
+            else:
+                path, added, last_seen, inserts = change
+                entries[path] = HistoryEntry(added=added, last_seen=last_seen, inserts=inserts)
+        if entries or tombstones:
+            yield entries, tombstones
+
+    def parse_lines(self, lines):
+        return json.loads('[' + ','.join(lines) + ']')
+
+    def write(self, f, entries, tombstones):
+        write_line = functools.partial(self.write_line, f)
+        write_line({
+            'format': RANKED_FILE_FORMAT,
+            'version': RANKED_FILE_VERSION,
+            'entries': len(entries),
+            'tombstones': len(tombstones),
+        })
+        for path, removed_at in tombstones.items():
+            write_line([path, removed_at])
+        for path, entry in entries.items():
+            write_line([path, entry.added, entry.last_seen, entry.inserts])
+
+    def append(self, f, entries, tombstones):
+        write_line = functools.partial(self.write_line, f)
+        for path, removed_at in tombstones.items():
+            write_line([path, removed_at])
+        for path, entry in entries.items():
+            write_line([path, entry.added, entry.last_seen, entry.inserts])
+
+    def write_line(self, f, value):
+        f.write(json.dumps(value, allow_nan=False) + '\n')
+
+HISTORY_STORES = {
+    'json': JsonHistoryStore(),
+    'ranked': RankedHistoryStore(),
+}
+
+# Read a history file in whichever format it's in, which needn't be the one the
+# settings ask for: we might have just switched. A ranked file starts with a
+# header line with the format first, see `RankedHistoryStore.write`. Only look
+# at the start of the file: a JSON one can be a single line, and parsing the
+# whole history just to find it isn't a header would take a while.
+RANKED_FILE_PREFIX = '{"format": ' + json.dumps(RANKED_FILE_FORMAT)
+
+def read_history_chunks(f):
+    prefix = f.read(len(RANKED_FILE_PREFIX))
+    f.seek(0)
+    if prefix == RANKED_FILE_PREFIX:
+        return HISTORY_STORES['ranked'].read_chunks(f)
+    else:
+        return HISTORY_STORES['json'].read_chunks(f)
+
+# Drop entries that were removed after they were last seen. Otherwise an entry
+# we removed could come back from a file saved before we removed it. Tombstones
+# for entries seen since are no use, so drop those instead.
+def apply_tombstones(history, tombstones):
+    for path_key, removed_at in list(tombstones.items()):
+        entry = history.get(path_key)
+        if entry is None:
+            continue
+        elif entry.last_seen <= removed_at:
+            del history[path_key]
+        else:
+            del tombstones[path_key]
+
+def merge_tombstones(mergee_tombstones, merger_tombstones):
+    for path_key, removed_at in merger_tombstones.items():
+        mergee_tombstones[path_key] = max(removed_at, mergee_tombstones.get(path_key, removed_at))
+
+# Call `on_first_chunk`, if given, once the first chunk of the file is in the
+# state, or straight away if there's nothing to load.
+def load_master_history_from_file(store_path, on_first_chunk=None):
+    logger.info('Loading from %s', store_path)
+    n_entries = 0
+    # A file can have no entries, or chunks with only tombstones, so we can't
+    # go by how many entries we've had.
+    published = False
     try:
-        with timed_operation('Fetch saved history'):
-            with open(store_path, 'r') as f:
-                stored_master_history = json.load(f)
+        with open(store_path, 'r') as f:
+            for stored_master_history, stored_tombstones in read_history_chunks(f):
+                with timed_operation('Intern saved paths'):
+                    stored_master_history = {
+                        path_table.intern(path): entry
+                        for path, entry in stored_master_history.items()
+                    }
+                    stored_tombstones = {
+                        path_table.intern(path): removed_at
+                        for path, removed_at in stored_tombstones.items()
+                    }
+                with timed_operation('Set saved history'):
+                    merge_stored_history(stored_master_history, stored_tombstones)
+                if not published and on_first_chunk is not None:
+                    on_first_chunk()
+                    published = True
+                n_entries += len(stored_master_history)
     except IOError as e:
-        log_debug(f'Could not load store at {store_path}: {e}')
-    else:
-        log_debug(f'Found {len(stored_master_history)} stored entries')
-        # Incorporate any history we might have accumulated before the load.
-        with timed_operation('Set saved history'):
+        logger.info('Could not load store at %s: %s', store_path, e)
+    logger.info('Found %d stored entries', n_entries)
+    if not published and on_first_chunk is not None:
+        on_first_chunk()
+
+# Incorporate some stored history into what we've accumulated so far. Anything
+# here that differs from what's stored came from paths we've seen, so is dirty
+# already.
+def merge_stored_history(stored_master_history, stored_tombstones):
+    with history_state.writing() as state:
+        merge_tombstones(
+            mergee_tombstones=state.tombstones,
+            merger_tombstones=stored_tombstones,
+        )
+        apply_tombstones(stored_master_history, state.tombstones)
+        # Tombstones can come after the entries they're for, when they're
+        # changes appended to a ranked file.
+        for path_key, removed_at in stored_tombstones.items():
+            entry = state.master_history.get(path_key)
+            if entry is not None and entry.last_seen <= removed_at:
+                remove_path_from_state(state, path_key)
+        # Merging keeps the larger count of the two sides, so a path seen once
+        # during the load would lose its saved count. So we count those visits
+        # on the saved entries first.
+        for path_key, seen_at in state.seen_during_load or ():
+            entry = stored_master_history.get(path_key)
+            if entry is not None:
+                stored_master_history[path_key] = entry.seen(seen_at)
+        # Merge the smaller history into the bigger one.
+        if len(stored_master_history) > len(state.master_history):
             merge_histories(
                 mergee_history=stored_master_history,
-                merger_history=global_state['master_history'],
+                merger_history=state.master_history,
+            )
+            state.master_history = stored_master_history
+        else:
+            merge_histories(
+                mergee_history=state.master_history,
+                merger_history=stored_master_history,
             )
-            global_state['master_history'].update(stored_master_history)
 
 def save_master_history_to_file(store_path, now):
     # Avoid saving entries that will be deleted anyway.
     remove_paths_to_remove()
+    # Don't hold up writers while we do IO. The snapshot has to go with the
+    # dirty paths we take: a change in between would be in neither. Tombstones
+    # aren't in snapshots, so we don't need `writing()` here.
+    with history_state.lock:
+        snapshot = history_state.snapshot()
+        dirty_paths, history_state.dirty_paths = history_state.dirty_paths, set()
+        appendable_file = history_state.appendable_file
+        tombstones = history_state.tombstones
+        for path_key, removed_at in list(tombstones.items()):
+            if now - removed_at > TOMBSTONE_MAX_AGE_SECONDS:
+                del tombstones[path_key]
+        tombstones = dict(tombstones)
+    if not dirty_paths and os.path.exists(store_path):
+        logger.debug('Nothing changed since the last save')
+        count_event('saves_skipped_clean')
+        return
+    store = get_history_store()
+    try:
+        with save_lock:
+            if (store.supports_append
+                    and appendable_file is not None
+                    and appendable_file[0] == store_path
+                    and appendable_file[1] + len(dirty_paths)
+                    <= max(MIN_CHANGES_BEFORE_REWRITE, len(snapshot.master_history) // 4)):
+                append_master_history_to_file(store, store_path, snapshot, tombstones, dirty_paths)
+                saved = True
+                n_changes = appendable_file[1] + len(dirty_paths)
+            else:
+                saved = write_master_history_to_file(store, store_path, snapshot, tombstones, now)
+                n_changes = 0
+    except BaseException:
+        saved = False
+        raise
+    finally:
+        with history_state.lock:
+            if saved:
+                history_state.appendable_file = (
+                    (store_path, n_changes) if store.supports_append else None
+                )
+            else:
+                # Try again with these next time.
+                history_state.dirty_paths |= dirty_paths
+
+# After this many changes appended to the history file, or a quarter of the
+# history if that's more, we write it out in full again.
+MIN_CHANGES_BEFORE_REWRITE = 1000
+
+def append_master_history_to_file(store, store_path, snapshot, tombstones, dirty_paths):
+    master_history = snapshot.master_history
+    with open(store_path, 'a') as f:
+        logger.debug('Appending %d changed entries to %s', len(dirty_paths), store_path)
+        store.append(
+            f,
+            {
+                path_table.get_path(path_key): master_history[path_key]
+                for path_key in dirty_paths if path_key in master_history
+            },
+            {
+                path_table.get_path(path_key): tombstones[path_key]
+                for path_key in dirty_paths if path_key in tombstones
+            },
+        )
+        count_event('saves_appended')
+        count_event('bytes_written', f.tell())
+
+def write_master_history_to_file(store, store_path, snapshot, tombstones, now):
+    tombstones = {
+        path_table.get_path(path_key): removed_at for path_key, removed_at in tombstones.items()
+    }
     with open(store_path, 'a+') as f:
         f.seek(0)
+        # Entries we removed on purpose don't count, see below. Changes appended
+        # since the last full write repeat paths from before, so count paths
+        # rather than entries.
+        stored_paths = set()
         try:
-            stored_master_history = json.load(f)
-        except json.decoder.JSONDecodeError:
-            stored_master_history = {}
+            for stored_master_history, _ in read_history_chunks(f):
+                stored_paths.update(stored_master_history)
+        except ValueError:
+            stored_paths = set()
+        n_stored_entries = len(stored_paths - tombstones.keys())
+        # Highest score first, as the ranked format wants.
         state_master_history = limit_entries(
-            global_state['master_history'],
+            snapshot.master_history,
             n=get_max_master_entries(),
             now=now,
         )
@@ -198,23 +1566,90 @@ def save_master_history_to_file(store_path, now):
         # entries because of file deletions, but if we are about to write many
         # fewer entries, that might be a sign we are about to do something we
         # regret, so let's just not do anything.
-        if len(state_master_history) > 0.7 * len(stored_master_history):
+        if len(state_master_history) > 0.7 * n_stored_entries:
             f.truncate(0)
-            log_debug(f'Saving {len(state_master_history)} entries to {store_path}')
-            json.dump(state_master_history, f, allow_nan=False, sort_keys=True, indent=2)
+            logger.debug('Saving %d entries to %s', len(state_master_history), store_path)
+            store.write(
+                f,
+                {
+                    path_table.get_path(path_key): entry
+                    for path_key, entry in state_master_history.items()
+                },
+                tombstones,
+            )
+            count_event('saves')
+            count_event('bytes_written', f.tell())
+            return True
+        else:
+            count_event('saves_skipped')
+            return False
 
-def populate_window_history_from_master(window):
-    window_history = get_window_history(window)
+# How many master entries to look through per step in tasks that go through
+# the whole master history, and how many garbage paths to remove per step.
+SCAN_STEP_ENTRIES = 2000
+REMOVE_STEP_PATHS = 1000
 
+def populate_window_history_from_master(window):
+    run_steps(populate_window_history_from_master_in_steps(window))
+
+# Populate a window as a task, so a big history doesn't hold anything up,
+# replacing any population of the window that's still going.
+def start_window_population(window, priority):
+    window_id = window.id()
+    previous_task = global_state['window_populations'].get(window_id)
+    if previous_task is not None:
+        previous_task.cancel()
+    task = start_task(
+        f'Populate window {window_id} history',
+        populate_window_history_from_master_in_steps(window),
+        priority,
+    )
+    global_state['window_populations'][window_id] = task
+    return task
+
+# A future for the population of the window if it's still going, else `None`.
+def get_window_population(window_id):
+    task = global_state['window_populations'].get(window_id)
+    if task is None or task.future.done():
+        return None
+    return task.future
+
+# We take a copy of the master's keys to look through, so we don't hold the
+# lock between steps, and only take it to add the ones that match, checking
+# they're still there.
+def populate_window_history_from_master_in_steps(window):
     window_folders = window.folders()
-    master_history = global_state['master_history']
+    window_id = window.id()
+    prefixes = set()
     for folder in window_folders:
-        for path in master_history:
-            if path.startswith(folder):
-                window_history[path] = master_history[path]
-        log_debug(
-            f'Populated window "{window.id()}" history with master entries under {folder}'
-        )
+        folder_id = path_table.lookup_directory(folder.rstrip(os.sep))
+        if folder_id is not None:
+            prefixes |= path_table.get_subtree_prefixes(folder_id)
+    if not prefixes:
+        return
+    with history_state.lock:
+        path_keys = list(history_state.master_history)
+    yield
+    prefix_length = PathTable.ID_BYTES
+    for start in range(0, len(path_keys), SCAN_STEP_ENTRIES):
+        matching_path_keys = [
+            path_key
+            for path_key in path_keys[start:start + SCAN_STEP_ENTRIES]
+            if path_key[:prefix_length] in prefixes
+        ]
+        if matching_path_keys:
+            with history_state.writing() as state:
+                # Like `add_window_path`, but this loop is hot.
+                master_history = state.master_history
+                window_paths = state.window_paths[window_id]
+                path_windows = state.path_windows
+                for path_key in matching_path_keys:
+                    if path_key in master_history and path_key not in window_paths:
+                        window_paths.add(path_key)
+                        path_windows[path_key] = path_windows.get(path_key, ()) + (window_id,)
+                state.window_paths_changed(window_id)
+        yield
+    logger.debug('Populated window "%s" history with master entries under %s', window_id, window_folders)
 
 def populate_window_history_from_views(window):
     now = get_time_seconds()
@@ -233,32 +1668,164 @@ def limit_entries(entries, n, now):
 
 def entry_frecency(entry, now):
     return frecency(
-        age=max(100, now - entry['last_seen']),
-        count=entry['inserts'],
+        age=max(100, now - entry.last_seen),
+        count=entry.inserts,
     )
 
-def historied_path_exists(path):
-    if os.path.exists(path):
-        return True
-    else:
-        log_debug(f'Could not find path {path}, adding to garbage')
-        global_state['paths_to_remove'].add(path)
-        return False
+# Check a path in the history exists, and if it's gone, mark it for removal.
+def check_historied_path_exists(path):
+    existence = check_path_exists(path)
+    if existence == PathExistence.MISSING:
+        logger.debug('Could not find path %s, adding to garbage', path)
+        path_key = path_table.lookup(path)
+        if path_key is not None:
+            with history_state.lock:
+                history_state.paths_to_remove.add(path_key)
+    return existence
+
+# Remove at most `max_paths` of them, if given.
+def remove_paths_to_remove(max_paths=None):
+    now = get_time_seconds()
+    with history_state.lock:
+        if not history_state.paths_to_remove:
+            return
+        if max_paths is None or len(history_state.paths_to_remove) <= max_paths:
+            paths_to_remove, history_state.paths_to_remove = history_state.paths_to_remove, set()
+        else:
+            paths_to_remove = {history_state.paths_to_remove.pop() for _ in range(max_paths)}
+    # Rebuilding each path to log it isn't free, so only do it if we keep the
+    # message.
+    log_removals = logger.isEnabledFor(logging.DEBUG)
+    with history_state.writing() as state:
+        for path_key_to_remove in paths_to_remove:
+            if log_removals:
+                logger.debug('Removing garbage path %s', path_table.get_path(path_key_to_remove))
+            if remove_path_from_state(state, path_key_to_remove):
+                state.tombstones[path_key_to_remove] = now
+                state.dirty_paths.add(path_key_to_remove)
+        count_event('paths_removed', len(paths_to_remove))
+
+def remove_paths_to_remove_in_steps():
+    while history_state.paths_to_remove:
+        remove_paths_to_remove(max_paths=REMOVE_STEP_PATHS)
+        yield
 
-def remove_paths_to_remove():
-    for path_to_remove in global_state['paths_to_remove']:
-        log_debug(f'Removing garbage path {path_to_remove}')
-        for window_history in global_state['window_histories'].values():
-            window_history.pop(path_to_remove, None)
-        global_state['master_history'].pop(path_to_remove, None)
+# Call while `writing()`. Returns whether the path was in the master history.
+def remove_path_from_state(state, path_key):
+    coaccess_graph.remove(path_key)
+    for window_id in state.path_windows.pop(path_key, ()):
+        window_paths = state.window_paths.get(window_id)
+        if window_paths is not None:
+            window_paths.discard(path_key)
+            state.window_paths_changed(window_id)
+    return state.master_history.pop(path_key, None) is not None
 
 def record_view_in_window(view, now):
-    window = view.window()
-    path = view.file_name()
-    # Only track views with a path, and not transient views.
-    if (path is not None and window is not None and not global_state['active']
-            and os.path.exists(path)):
+    record_path_in_window(view.window(), view.file_name(), now)
+
+# Returns whether we recorded it now, rather than deferred or dropped it.
+def record_path_in_window(window, path, now):
+    # Only track views with a path. An activation can outlive its window, if
+    # it's closed while the activation is queued or deferred, and we don't want
+    # to bring its history back.
+    if path is None or window is None or not window.is_valid():
+        return False
+    if global_state['active']:
+        # Don't touch the state while the panel is open, but don't lose the
+        # activation either: it might be a real one, say from another window.
+        global_state['deferred_activations'].append((window, path, now))
+        count_event('activations_deferred')
+        return False
+    # The view is open, so if we can't tell whether the file is there, it
+    # likely is.
+    elif check_path_exists(path) != PathExistence.MISSING:
         record_seen_path_in_window(window, path, now)
+        count_event('activations_recorded')
+        return True
+    else:
+        return False
+
+# Call from the async thread: recording checks each path exists and saves
+# every so often, neither of which should hold up the UI.
+def replay_deferred_activations():
+    # If the panel is open again already, these wait for it to close again,
+    # along with anything it defers.
+    if global_state['active']:
+        return
+    deferred_activations = global_state['deferred_activations']
+    n_deferred = len(deferred_activations)
+    if n_deferred:
+        logger.debug('Replaying %d deferred activations', n_deferred)
+    # Only as many as there were, in case the panel opens while we're at it
+    # and they start to come back.
+    for _ in range(n_deferred):
+        record_path_in_window(*deferred_activations.popleft())
+
+# Drop what we track per window for windows that have been closed, so a long
+# session doesn't accumulate state for every window it ever had. Call from the
+# async thread, like the activation drain that also uses this state.
+def forget_windows(window_ids):
+    if not window_ids:
+        return
+    logger.info('Forgetting closed windows %s', sorted(window_ids))
+    count_event('windows_forgotten', len(window_ids))
+    for window_id in window_ids:
+        population = global_state['window_populations'].pop(window_id, None)
+        if population is not None:
+            population.cancel()
+    with history_state.writing() as state:
+        for window_id in window_ids:
+            state.window_paths_changed(window_id)
+            for path_key in state.window_paths.pop(window_id, ()):
+                remaining_window_ids = tuple(
+                    other_window_id
+                    for other_window_id in state.path_windows.get(path_key, ())
+                    if other_window_id != window_id
+                )
+                if remaining_window_ids:
+                    state.path_windows[path_key] = remaining_window_ids
+                else:
+                    state.path_windows.pop(path_key, None)
+    # The main thread adds previewed paths, so take a copy to walk.
+    recent_activations = global_state['recent_activations']
+    for key in list(recent_activations):
+        if key[0] in window_ids:
+            recent_activations.pop(key, None)
+    previewed_paths = global_state['previewed_paths']
+    for key in list(previewed_paths):
+        if key[0] in window_ids:
+            previewed_paths.discard(key)
+    last_recorded_paths = global_state['last_recorded_paths']
+    for window_id in window_ids:
+        last_recorded_paths.pop(window_id, None)
+    with tracing['lock']:
+        tracing['seen_window_ids'] -= window_ids
+
+# Closing a window can be cancelled, say from its prompt to save changes, and
+# then we'd leave it with no history. So only forget it if it's gone.
+def forget_window_unless_active(window_id):
+    if global_state['active'] or window_id in {window.id() for window in sublime.windows()}:
+        return
+    forget_windows({window_id})
+
+# We hear about most windows closing from `on_pre_close_window`, but not all:
+# not while the panel is open, and not from Sublime builds without the event.
+# So every so often, check what we track against the windows that are open.
+def forget_closed_windows():
+    open_window_ids = {window.id() for window in sublime.windows()}
+    with history_state.lock:
+        tracked_window_ids = set(history_state.window_paths)
+    tracked_window_ids.update(key[0] for key in list(global_state['recent_activations']))
+    tracked_window_ids.update(key[0] for key in list(global_state['previewed_paths']))
+    forget_windows(tracked_window_ids - open_window_ids)
+
+# Sublime calls this once the API is ready.
+def plugin_loaded():
+    start_history_load()
+
+def plugin_unloaded():
+    stop_watching()
+    stop_tracing()
 
 # /Global state.
 
@@ -292,6 +1859,735 @@ def recency_score(ds):
 
 # /Frecency.
 
+# Preview.
+
+# How much of the start of a file to look at when guessing if it's binary.
+BINARY_SNIFF_BYTES = 1024
+
+# Opening a view for a huge log file, or for a binary blob, is slow and not
+# very useful, so we'd rather not preview those. Return a short description of
+# why we're skipping the file, or `None` if it looks fine to preview.
+def get_preview_skip_reason(path):
+    try:
+        size = os.path.getsize(path)
+        if size > get_file_preview_max_bytes():
+            return f'too large ({size / 1e6:.1f} MB)'
+        with open(path, 'rb') as f:
+            if b'\0' in f.read(BINARY_SNIFF_BYTES):
+                return 'looks binary'
+    except OSError as e:
+        return f'could not read ({e})'
+    return None
+
+class FilePreviewMode(Enum):
+    # Open the file in a transient view.
+    VIEW = 'view'
+    # Show the first few lines of the file in an output panel.
+    SNIPPET = 'snippet'
+
+PREVIEW_PANEL_NAME = 'frecent_history_preview'
+
+# Upper bound on how much we read per snippet line, so a file with no newlines
+# still only costs a small read.
+SNIPPET_BYTES_PER_LINE = 256
+
+# Keyed on the modification time as well as the path, so an edited file gets
+# re-read, and on the number of lines in case the setting changes. Highlighting
+# an entry we've already seen then costs just a `stat`.
+@functools.lru_cache(maxsize=256)
+def read_file_snippet(path, mtime_ns, n_lines):
+    with open(path, 'rb') as f:
+        head = f.read(max(BINARY_SNIFF_BYTES, n_lines * SNIPPET_BYTES_PER_LINE))
+    if b'\0' in head[:BINARY_SNIFF_BYTES]:
+        return '(Binary file)'
+    else:
+        return '\n'.join(head.decode('utf-8', errors='replace').splitlines()[:n_lines])
+
+def get_file_snippet(path, n_lines):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        return read_file_snippet(path, mtime_ns, n_lines)
+    except OSError as e:
+        return f'(Could not read file: {e})'
+
+def show_file_snippet(window, path):
+    panel = window.create_output_panel(PREVIEW_PANEL_NAME)
+    panel.set_read_only(False)
+    panel.run_command('select_all')
+    panel.run_command('right_delete')
+    panel.run_command('append', {
+        'characters': f'{path}\n\n{get_file_snippet(path, get_file_preview_snippet_lines())}',
+        'scroll_to_end': False,
+    })
+    panel.set_read_only(True)
+    window.run_command('show_panel', {'panel': f'output.{PREVIEW_PANEL_NAME}'})
+
+def hide_file_snippet(window):
+    window.run_command('hide_panel', {'panel': f'output.{PREVIEW_PANEL_NAME}'})
+
+# /Preview.
+
+# Activations.
+
+# Cycling through tabs, or running a macro, can activate many views a second,
+# and we don't want each of those to count as a visit. So activations go into
+# a queue that we drain in batches. A view only counts once it has stayed
+# focused for a while, and activating a path again soon after we recorded it
+# doesn't count again.
+
+Activation = namedtuple('Activation', ['window', 'path', 'tick_ms', 'now', 'during_panel'])
+
+def queue_activation(view):
+    count_event('activation_events')
+    global_state['activation_queue'].append(Activation(
+        window=view.window(),
+        path=view.file_name(),
+        tick_ms=get_tick_ms(),
+        now=get_time_seconds(),
+        during_panel=global_state['active'],
+    ))
+    schedule_activation_drain(get_activation_dwell_ms())
+
+def schedule_activation_drain(delay_ms):
+    if not global_state['activation_drain_scheduled']:
+        global_state['activation_drain_scheduled'] = True
+        sublime.set_timeout_async(drain_activations, delay_ms)
+
+def drain_activations():
+    with profiled_operation():
+        drain_activation_queue()
+
+def drain_activation_queue():
+    global_state['activation_drain_scheduled'] = False
+    if next(global_state['window_check_cycle']) and not global_state['active']:
+        forget_closed_windows()
+    queue = global_state['activation_queue']
+    recent_activations = global_state['recent_activations']
+    dwell_ms = get_activation_dwell_ms()
+    coalesce_ms = get_activation_coalesce_ms()
+    tick_ms = get_tick_ms()
+
+    # Forget activations too old to collapse anything into.
+    for key, recorded_tick_ms in list(recent_activations.items()):
+        if tick_ms - recorded_tick_ms >= coalesce_ms:
+            del recent_activations[key]
+
+    n_recorded = 0
+    n_drained = len(queue)
+    count_event('activation_drains')
+    while queue:
+        activation = queue.popleft()
+        # A view stays focused until the next activation, whatever window
+        # that's in. Views without a path are in the queue just to mark that.
+        focused_until_ms = queue[0].tick_ms if queue else tick_ms
+        if focused_until_ms - activation.tick_ms < dwell_ms:
+            if not queue:
+                # This is the latest activation and it might still count, so
+                # check back once it could have been focused for long enough.
+                queue.appendleft(activation)
+                schedule_activation_drain(dwell_ms - (tick_ms - activation.tick_ms))
+                break
+            else:
+                continue
+        if activation.window is None or activation.path is None:
+            continue
+        key = (activation.window.id(), activation.path)
+        if key in recent_activations:
+            continue
+        # Previews we open ourselves are transient, and not really visits.
+        if activation.during_panel and key in global_state['previewed_paths']:
+            continue
+        recent_activations[key] = activation.tick_ms
+        if record_path_in_window(activation.window, activation.path, activation.now):
+            # Deferred activations come back in the order they happened, but
+            # mixed in with whatever the panel opened, so we only count
+            # transitions between activations we record as they happen.
+            record_transition(activation.window.id(), activation.path, activation.now)
+            n_recorded += 1
+    # Including any we deferred, which count as recorded if they are when
+    # they're replayed.
+    count_event('activations_filtered', n_drained - len(queue) - n_recorded)
+    logger.debug('Drained %d activations, recorded %d', n_drained, n_recorded)
+
+# /Activations.
+
+# Watching.
+
+# Paths in the history get renamed and deleted behind our back. We find out a
+# path is gone the next time we check it exists, but by then a renamed path has
+# lost its history. So on Linux, with `watch_renames` on, we have inotify tell
+# us about changes in the directories holding the top-ranked entries: a deleted
+# path gets its tombstone straight away, and a renamed one takes its entry with
+# it. We talk to inotify through `ctypes`, so there's nothing to install.
+
+# From `<sys/inotify.h>`.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# Each event is a `struct inotify_event`: the watch descriptor, mask, cookie
+# and length of the name, then the name, padded with NULs.
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_BYTES = 64 * 1024
+
+# A rename comes as a moved-from event and a moved-to event with the same
+# cookie. If the moved-to doesn't come within this long, the path went
+# somewhere we don't watch, so we count it as deleted.
+MOVE_PAIR_TIMEOUT_MS = 100
+
+# Editors that save by moving the old file out of the way, or deleting it, put
+# a new one straight back. So we wait this long before acting on an event, and
+# then only if the path is still gone.
+WATCH_SETTLE_MS = 200
+
+# How often the watched directories follow the ranking, at most.
+WATCH_REFRESH_MIN_MS = 60 * 1000
+
+# A path that was deleted, if `new_path` is `None`, or renamed.
+WatchEvent = namedtuple('WatchEvent', ['old_path', 'new_path', 'is_directory'])
+
+class InotifyWatcher:
+
+    def __init__(self, on_events, on_failed):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.inotify_rm_watch = libc.inotify_rm_watch
+        self.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # Called on the watcher's thread with each batch of `WatchEvent`s, and
+        # with the watcher if the thread stops on an error.
+        self.on_events = on_events
+        self.on_failed = on_failed
+        # Guards the maps below, which both threads use.
+        self.lock = threading.Lock()
+        self.directories = {}
+        self.watch_descriptors = {}
+        # Once we've closed the descriptors, whose numbers might since have been
+        # reused for something else.
+        self.closed = False
+        # Writing to this wakes the thread up to stop.
+        self.wake_fd, self.stop_fd = os.pipe()
+        self.thread = threading.Thread(target=self.run, name='FrecentHistory-watch', daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.watch_descriptors)
+
+    # Watch these directories and no others, apart from any we can't.
+    def set_directories(self, directories):
+        directories = set(directories)
+        with self.lock:
+            if self.closed:
+                return
+            for directory in list(self.watch_descriptors):
+                if directory not in directories:
+                    # We forget the descriptor when we get its `IN_IGNORED`,
+                    # as there might be events for it still to read.
+                    self.inotify_rm_watch(self.fd, self.watch_descriptors.pop(directory))
+            for directory in directories.difference(self.watch_descriptors):
+                watch_descriptor = self.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+                if watch_descriptor < 0:
+                    logger.debug('Could not watch %s: %s', directory, os.strerror(ctypes.get_errno()))
+                # Another path to a directory we watch already, like through a
+                # symlink.
+                elif watch_descriptor in self.directories:
+                    continue
+                else:
+                    self.watch_descriptors[directory] = watch_descriptor
+                    self.directories[watch_descriptor] = directory
+
+    # Only close the descriptors once the thread is done with them. Waking it
+    # is harmless if it's stopped already, as the pipe is still ours.
+    def close(self):
+        os.write(self.stop_fd, b'\0')
+        self.thread.join()
+        with self.lock:
+            self.closed = True
+            for fd in [self.fd, self.wake_fd, self.stop_fd]:
+                os.close(fd)
+
+    def run(self):
+        # Map from cookie to the moved-from `WatchEvent` waiting for its
+        # moved-to, and when it came.
+        pending_moves = {}
+        try:
+            while True:
+                timeout = MOVE_PAIR_TIMEOUT_MS / 1000 if pending_moves else None
+                readable, _, _ = select.select([self.fd, self.wake_fd], [], [], timeout)
+                if self.wake_fd in readable:
+                    return
+                events = []
+                if self.fd in readable:
+                    self.read_events(os.read(self.fd, INOTIFY_READ_BYTES), events, pending_moves)
+                # Renames whose other half we've given up on.
+                now = time.monotonic()
+                for cookie, (event, moved_at) in list(pending_moves.items()):
+                    if now - moved_at >= MOVE_PAIR_TIMEOUT_MS / 1000:
+                        del pending_moves[cookie]
+                        events.append(event)
+                if events:
+                    self.on_events(events)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Stopped watching after an error')
+            self.on_failed(self)
+
+    def read_events(self, data, events, pending_moves):
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, cookie, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # We'll find out about what we missed when we next check the
+                # paths exist.
+                logger.warning('Missed some changes to watched directories')
+                count_event('watch_overflows')
+                continue
+            with self.lock:
+                directory = self.directories.get(watch_descriptor)
+                if mask & IN_IGNORED:
+                    self.directories.pop(watch_descriptor, None)
+                    if self.watch_descriptors.get(directory) == watch_descriptor:
+                        del self.watch_descriptors[directory]
+                    continue
+                # The watch follows the directory, but we'd have the wrong path
+                # for it. If it's still worth watching, the next refresh will
+                # watch it where it is now.
+                if mask & IN_MOVE_SELF and directory is not None:
+                    self.inotify_rm_watch(self.fd, watch_descriptor)
+                    continue
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            is_directory = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                pending_moves[cookie] = (WatchEvent(path, None, is_directory), time.monotonic())
+            elif mask & IN_MOVED_TO:
+                moved_from = pending_moves.pop(cookie, None)
+                # Moved in from somewhere we don't watch, so we don't know
+                # what it was.
+                if moved_from is not None:
+                    events.append(moved_from[0]._replace(new_path=path))
+            elif mask & IN_DELETE:
+                events.append(WatchEvent(path, None, is_directory))
+            elif mask & IN_DELETE_SELF:
+                events.append(WatchEvent(directory, None, True))
+
+watching = {
+    'lock': threading.Lock(),
+    # The `InotifyWatcher`, while we're watching.
+    'watcher': None,
+    # Whether we tried to watch and couldn't, so we don't keep trying.
+    'unavailable': False,
+    # The last refresh of the watched directories, see
+    # `refresh_watched_directories`, and when it started.
+    'refresh': None,
+    'refreshed_tick_ms': None,
+}
+
+def get_watcher():
+    with watching['lock']:
+        if watching['watcher'] is None and not watching['unavailable']:
+            if not sys.platform.startswith('linux'):
+                logger.warning('Not watching for renames: inotify is only on Linux')
+                watching['unavailable'] = True
+            else:
+                try:
+                    watching['watcher'] = InotifyWatcher(on_watch_events, on_watcher_failed)
+                except (OSError, AttributeError) as e:
+                    logger.warning('Not watching for renames: %s', e)
+                    watching['unavailable'] = True
+        return watching['watcher']
+
+def stop_watching():
+    with watching['lock']:
+        watcher, watching['watcher'] = watching['watcher'], None
+        if watching['refresh'] is not None:
+            watching['refresh'].cancel()
+    if watcher is not None:
+        watcher.close()
+
+# Called on the watcher's thread as it stops. Whatever stopped it would likely
+# stop the next one too, so don't try again. Whoever takes the watcher out of
+# `watching` closes it, so that only happens once.
+def on_watcher_failed(watcher):
+    with watching['lock']:
+        if watching['watcher'] is not watcher:
+            return
+        watching['watcher'] = None
+        watching['unavailable'] = True
+    # It can't wait for its own thread.
+    sublime.set_timeout_async(watcher.close, 0)
+
+# Watch the directories with the highest frecency, counting all the entries in
+# each. Called once the history loads and after saves, so the watches follow
+# the ranking, but not more often than `WATCH_REFRESH_MIN_MS`.
+def refresh_watched_directories():
+    if not get_watch_renames():
+        stop_watching()
+        return
+    tick_ms = get_tick_ms()
+    with watching['lock']:
+        refresh = watching['refresh']
+        if refresh is not None and not refresh.future.done():
+            return
+        refreshed_tick_ms = watching['refreshed_tick_ms']
+        if refreshed_tick_ms is not None and tick_ms - refreshed_tick_ms < WATCH_REFRESH_MIN_MS:
+            return
+        watching['refreshed_tick_ms'] = tick_ms
+        watching['refresh'] = start_task(
+            'Refresh watched directories', refresh_watched_directories_in_steps(), TaskPriority.LOW,
+        )
+
+def refresh_watched_directories_in_steps():
+    now = get_time_seconds()
+    with history_state.lock:
+        items = list(history_state.master_history.items())
+    yield
+    # Map from directory prefix of the path keys, see `PathTable`, to the sum
+    # of the frecencies of its entries.
+    directory_scores = defaultdict(float)
+    prefix_length = PathTable.ID_BYTES
+    for start in range(0, len(items), SCAN_STEP_ENTRIES):
+        for path_key, entry in items[start:start + SCAN_STEP_ENTRIES]:
+            directory_scores[path_key[:prefix_length]] += entry_frecency(entry, now)
+        yield
+    # Adding a watch resolves the path there and then, so would block on a
+    # hung mount. And changes on a remote mount made from elsewhere, which is
+    # most of them, don't reach inotify anyway.
+    ranked_prefixes = sorted(directory_scores, key=directory_scores.get, reverse=True)
+    directories = list(itertools.islice(
+        filter(is_on_healthy_local_mount, (
+            path_table.get_directory_path(int.from_bytes(prefix, 'big')) for prefix in ranked_prefixes
+        )),
+        get_max_watched_directories(),
+    ))
+    watcher = get_watcher()
+    if watcher is not None:
+        watcher.set_directories(directories)
+        logger.debug('Watching %d directories', len(watcher))
+
+# Called on the watcher's thread.
+def on_watch_events(events):
+    sublime.set_timeout_async(functools.partial(apply_watch_events, events), WATCH_SETTLE_MS)
+
+# Most changes in a watched directory, like from a build or a checkout, are to
+# paths we don't have, so check that before going to the disk.
+def apply_watch_events(events):
+    now = get_time_seconds()
+    for event in events:
+        if event.is_directory:
+            if path_table.lookup_directory(event.old_path) is None:
+                continue
+        else:
+            path_key = path_table.lookup(event.old_path)
+            if path_key is None:
+                continue
+            with history_state.lock:
+                if path_key not in history_state.master_history:
+                    continue
+        # Put back since, like by an editor saving.
+        if check_path_exists(event.old_path) != PathExistence.MISSING:
+            continue
+        if event.is_directory:
+            start_task(
+                f'Follow changes under {event.old_path}',
+                apply_directory_watch_event_in_steps(event, now),
+                TaskPriority.NORMAL,
+            )
+            continue
+        with history_state.writing() as state:
+            if event.new_path is None:
+                if remove_path_from_state(state, path_key):
+                    logger.debug('Removing deleted path %s', event.old_path)
+                    state.tombstones[path_key] = now
+                    state.dirty_paths.add(path_key)
+                    count_event('watched_deletions')
+            elif move_history_entry(state, path_key, event.new_path, now):
+                logger.debug('Moving %s to %s', event.old_path, event.new_path)
+                count_event('watched_renames')
+
+# Everything under a deleted or renamed directory goes with it.
+def apply_directory_watch_event_in_steps(event, now):
+    directory_id = path_table.lookup_directory(event.old_path)
+    if directory_id is None:
+        return
+    prefixes = path_table.get_subtree_prefixes(directory_id)
+    with history_state.lock:
+        path_keys = list(history_state.master_history)
+    yield
+    prefix_length = PathTable.ID_BYTES
+    old_path_length = len(event.old_path)
+    for start in range(0, len(path_keys), SCAN_STEP_ENTRIES):
+        matching_path_keys = [
+            path_key
+            for path_key in path_keys[start:start + SCAN_STEP_ENTRIES]
+            if path_key[:prefix_length] in prefixes
+        ]
+        if matching_path_keys:
+            with history_state.writing() as state:
+                for path_key in matching_path_keys:
+                    if event.new_path is None:
+                        if remove_path_from_state(state, path_key):
+                            state.tombstones[path_key] = now
+                            state.dirty_paths.add(path_key)
+                            count_event('watched_deletions')
+                    else:
+                        new_path = event.new_path + path_table.get_path(path_key)[old_path_length:]
+                        if move_history_entry(state, path_key, new_path, now):
+                            count_event('watched_renames')
+        yield
+    logger.debug('Followed %s to %s', event.old_path, event.new_path)
+
+# Call while `writing()`. Give the entry for a path to its new path, in the
+# same windows, and leave a tombstone for the old one. Returns whether there
+# was an entry to move.
+def move_history_entry(state, path_key, new_path, now):
+    entry = state.master_history.get(path_key)
+    if entry is None:
+        return False
+    window_ids = state.path_windows.get(path_key, ())
+    remove_path_from_state(state, path_key)
+    state.tombstones[path_key] = now
+    state.dirty_paths.add(path_key)
+    new_path_key = path_table.intern(new_path)
+    # Whatever was at the new path before was replaced.
+    state.master_history[new_path_key] = entry
+    for window_id in window_ids:
+        state.add_window_path(window_id, new_path_key)
+    state.tombstones.pop(new_path_key, None)
+    state.dirty_paths.add(new_path_key)
+    return True
+
+# /Watching.
+
+# Co-access.
+
+# Some files get used together, like a module and its tests, so we count how
+# often activating one path is followed by activating another in the same
+# window. The panel can then offer the paths that usually come after the
+# current one, see `OpenFrecentFileCommand`, and with `prefetch_related_files`
+# on, we warm the caches for the likeliest of them so they preview quickly.
+
+# To keep the graph small however big the history, we keep the strongest few
+# successors per path, and only for the paths we most recently left. Weights
+# halve every so often, so the graph follows how the files are used now.
+COACCESS_MAX_PATHS = 10000
+COACCESS_MAX_SUCCESSORS = 8
+COACCESS_HALF_LIFE_SECONDS = 2 * SECONDS_PER_WEEK
+
+# How many of the likeliest next paths to prefetch.
+PREFETCH_PATHS = 3
+
+class CoAccessGraph:
+
+    def __init__(self):
+        # Transitions are recorded on the async thread, and read on the main
+        # one.
+        self.lock = threading.Lock()
+        # Map from path key to a list of when its weights last decayed, and a
+        # dict from the path key of each successor to its weight. They all
+        # decay at the same rate, so one time per path will do. Least recently
+        # updated first.
+        self.successors = OrderedDict()
+
+    def __len__(self):
+        return len(self.successors)
+
+    def record(self, path_key, next_path_key, now):
+        with self.lock:
+            node = self.successors.get(path_key)
+            if node is None:
+                node = self.successors[path_key] = [now, {}]
+                if len(self.successors) > COACCESS_MAX_PATHS:
+                    self.successors.popitem(last=False)
+            else:
+                self.successors.move_to_end(path_key)
+                if now > node[0]:
+                    factor = 0.5 ** ((now - node[0]) / COACCESS_HALF_LIFE_SECONDS)
+                    node[0] = now
+                    for successor_key in node[1]:
+                        node[1][successor_key] *= factor
+            weights = node[1]
+            if next_path_key not in weights and len(weights) >= COACCESS_MAX_SUCCESSORS:
+                del weights[min(weights, key=weights.get)]
+            weights[next_path_key] = weights.get(next_path_key, 0.0) + 1.0
+
+    # Map from the path key of each successor of a path to its weight.
+    def get_successors(self, path_key):
+        with self.lock:
+            node = self.successors.get(path_key)
+            return {} if node is None else dict(node[1])
+
+    # We don't go looking for the path as a successor: those drop out when we
+    # read them and find no entry for them, or get pushed out by others.
+    def remove(self, path_key):
+        with self.lock:
+            self.successors.pop(path_key, None)
+
+coaccess_graph = CoAccessGraph()
+
+def record_transition(window_id, path, now):
+    path_key = path_table.lookup(path)
+    last_recorded_paths = global_state['last_recorded_paths']
+    previous_path_key = last_recorded_paths.get(window_id)
+    last_recorded_paths[window_id] = path_key
+    if previous_path_key is None or previous_path_key == path_key or path_key is None:
+        return
+    coaccess_graph.record(previous_path_key, path_key, now)
+    count_event('transitions_recorded')
+    if get_prefetch_related_files():
+        start_task('Prefetch related files', prefetch_related_files_in_steps(path_key), TaskPriority.LOW)
+
+# Map from the path key of each path that has followed `path_key`, and still
+# has an entry, to its weight.
+def get_related_paths(path_key, master_history):
+    return {
+        successor_key: weight
+        for successor_key, weight in coaccess_graph.get_successors(path_key).items()
+        if successor_key in master_history
+    }
+
+# Checking a path exists puts its metadata in the OS's cache, and reading the
+# start of it for a preview puts that in our snippet cache, or the OS's if we
+# preview in a view.
+def prefetch_related_files_in_steps(path_key):
+    with history_state.lock:
+        related_paths = get_related_paths(path_key, history_state.master_history)
+    for successor_key in heapq.nlargest(PREFETCH_PATHS, related_paths, key=related_paths.get):
+        yield
+        path = path_table.get_path(successor_key)
+        if check_historied_path_exists(path) != PathExistence.EXISTS:
+            continue
+        if get_file_preview_mode() == FilePreviewMode.SNIPPET:
+            get_file_snippet(path, get_file_preview_snippet_lines())
+        else:
+            get_preview_skip_reason(path)
+        count_event('paths_prefetched')
+
+# /Co-access.
+
+# Memory.
+
+# To tell whether we're behind the plugin host growing, we estimate how much
+# memory each of our structures holds on to: the object itself plus everything
+# it references, like `sys.getsizeof` but deep.
+
+# How many of the biggest window histories to list.
+TOP_WINDOW_HISTORIES = 10
+
+# Code and types aren't data we hold, and would drag in half the interpreter.
+NOT_DATA_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType)
+
+# Objects already in `seen` aren't counted again, so passing the same `seen` to
+# several calls splits shared objects between them rather than counting them
+# twice.
+def deep_sizeof(root, seen):
+    size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, NOT_DATA_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+def render_bytes(n_bytes):
+    for unit in ['B', 'KiB', 'MiB']:
+        if n_bytes < 1024 or unit == 'MiB':
+            break
+        n_bytes /= 1024
+    return f'{n_bytes:.1f} {unit}' if unit != 'B' else f'{n_bytes} B'
+
+def render_memory_report():
+    # Walking everything takes a while with a big history, and the main thread
+    # shouldn't wait on the lock for that. So take shallow copies under it, and
+    # walk those: the entries and keys in them are the real ones, just the
+    # containers are new, and about the same size.
+    with history_state.lock:
+        master_history = dict(history_state.master_history)
+        window_paths = {
+            window_id: set(paths) for window_id, paths in history_state.window_paths.items()
+        }
+        path_windows = dict(history_state.path_windows)
+        paths_to_remove = set(history_state.paths_to_remove)
+        tombstones = dict(history_state.tombstones)
+        snapshot = history_state.latest_snapshot
+
+    # Each row is (name, count, bytes). We measure the master history first, so
+    # the entries and keys it shares with other structures count towards it.
+    seen = set()
+    rows = []
+    rows.append(('master_history', len(master_history), deep_sizeof(master_history, seen)))
+    window_rows = [
+        (f'window {window_id} history', len(paths), deep_sizeof(paths, seen))
+        for window_id, paths in window_paths.items()
+    ]
+    rows.append(('path_windows', len(path_windows), deep_sizeof(path_windows, seen)))
+    rows.append(('paths_to_remove', len(paths_to_remove), deep_sizeof(paths_to_remove, seen)))
+    rows.append(('tombstones', len(tombstones), deep_sizeof(tombstones, seen)))
+    rows.append((
+        'history snapshot',
+        len(snapshot.master_history) if snapshot is not None else 0,
+        deep_sizeof(snapshot, seen),
+    ))
+    rows.append(('path_table directories', len(path_table), deep_sizeof(path_table, seen)))
+    for name in ['activation_queue', 'recent_activations', 'deferred_activations', 'previewed_paths']:
+        structure = global_state[name]
+        rows.append((name, len(structure), deep_sizeof(structure, seen)))
+    for cache_name, cache_function in [
+            ('snippet_cache', read_file_snippet),
+            ('path_shortener_cache', get_path_shortener),
+    ]:
+        rows.append((cache_name, cache_function.cache_info().currsize, deep_sizeof(cache_function, seen)))
+    # Likewise, recording a transition shouldn't wait for this.
+    with coaccess_graph.lock:
+        successors = coaccess_graph.successors.copy()
+    rows.append(('coaccess graph', len(successors), deep_sizeof(successors, seen)))
+    rows.append(('log ring buffer', len(log_ring.records), deep_sizeof(log_ring.records, seen)))
+    with metrics['lock']:
+        rows.append(('timing samples', len(metrics['timings']), deep_sizeof(metrics['timings'], seen)))
+
+    window_bytes = sum(n_bytes for _, _, n_bytes in window_rows)
+    window_count = sum(count for _, count, _ in window_rows)
+    rows.append((f'window histories ({len(window_rows)})', window_count, window_bytes))
+
+    total_bytes = sum(n_bytes for _, _, n_bytes in rows)
+    name_width = max(len(name) for name, _, _ in rows + window_rows)
+    line_format = '{:<{w}} {:>10} {:>12}'
+    lines = [
+        'FrecentHistory memory usage (estimated, shared objects counted once)',
+        '',
+        line_format.format('Structure', 'entries', 'size', w=name_width),
+    ]
+    for name, count, n_bytes in sorted(rows, key=lambda row: row[2], reverse=True):
+        lines.append(line_format.format(name, count, render_bytes(n_bytes), w=name_width))
+    lines.append(line_format.format('total', '', render_bytes(total_bytes), w=name_width))
+    if window_rows:
+        lines += ['', 'Biggest window histories']
+        top_window_rows = sorted(window_rows, key=lambda row: row[2], reverse=True)[:TOP_WINDOW_HISTORIES]
+        for name, count, n_bytes in top_window_rows:
+            lines.append(line_format.format(name, count, render_bytes(n_bytes), w=name_width))
+    return '\n'.join(lines) + '\n'
+
+# /Memory.
+
 # Event listener.
 
 # We record the view when a file is 'activated', basically viewed, opened and
@@ -299,21 +2595,53 @@ def recency_score(ds):
 class OpenFrecentFileEvent(sublime_plugin.EventListener):  # pylint: disable=too-few-public-methods
 
     def on_activated_async(self, view):  # pylint: disable=no-self-use
-        record_view_in_window(view, now=get_time_seconds())
+        trace_event(view.window(), 'a', view.file_name())
+        queue_activation(view)
+
+    def on_pre_close_window(self, window):  # pylint: disable=no-self-use
+        window_id = window.id()
+        # Give the window time to actually close. If it takes longer, we'll
+        # notice it's gone later, see `forget_closed_windows`.
+        sublime.set_timeout_async(lambda: forget_window_unless_active(window_id), WINDOW_CLOSE_WAIT_MS)
 
 # /Event listener.
 
 # Comand.
 
-# Abbreviate some prefixes to render paths more nicely.
-def shorten_path(path, heres):
-    path_path = pathlib.Path(path)
-    abbrevs = [(here, '.') for here in heres] + [(HOME, '~')]
-    for prefix, abbrev in abbrevs:
-        try:
-            return str(abbrev / path_path.relative_to(prefix))
-        except ValueError:
-            continue
+# Abbreviate some prefixes to render paths more nicely. We shorten a path for
+# every row in the panel, so do the prefix work once per set of window folders
+# rather than once per row.
+class PathShortener:  # pylint: disable=too-few-public-methods
+
+    def __init__(self, heres):
+        # Prefixes are tried in order, and the first match wins, so window
+        # folders take precedence over the home directory.
+        self.prefixes = [
+            self.normalize_prefix(prefix, abbrev)
+            for prefix, abbrev in [(here, '.') for here in heres] + [(HOME, '~')]
+        ]
+
+    @staticmethod
+    def normalize_prefix(prefix, abbrev):
+        prefix = os.path.normcase(prefix).rstrip(os.sep)
+        # Only match whole path components, so '/foo' doesn't match '/foobar'.
+        return prefix, prefix + os.sep, abbrev
+
+    def __call__(self, path):
+        cased_path = os.path.normcase(path)
+        for prefix, prefix_with_sep, abbrev in self.prefixes:
+            if cased_path == prefix:
+                return abbrev
+            elif cased_path.startswith(prefix_with_sep):
+                relative_path = path[len(prefix_with_sep):]
+                # Paths under a window folder are just shown relative to it,
+                # without a leading './'.
+                return relative_path if abbrev == '.' else abbrev + os.sep + relative_path
+        return path
+
+@functools.lru_cache(maxsize=32)
+def get_path_shortener(heres):
+    return PathShortener(heres)
 
 def render_access_count(x):
     if x == 0:
@@ -325,12 +2653,65 @@ def render_access_count(x):
     else:
         return 'seen {} times'.format(natural.number.word(x, digits=1))
 
-def render_subtitle(attrs):
+# `natural.date.duration` looks its words up in the translation catalog every
+# time it's called, several times per row. So we look them up once per locale,
+# going by the translation function `natural.date` uses, and render the rows
+# with plain string formatting. This has to match what
+# `natural.date.duration(t, precision=2)` would say exactly.
+class SubtitleTemplates:
+
+    def __init__(self, translate):
+        self.ago = translate('%s ago')
+        self.from_now = translate('%s from now')
+        # Each unit as its length in seconds, and its singular and plural
+        # templates, biggest first. `natural` goes no bigger than weeks.
+        self.units = [
+            (natural.date.TIME_WEEK, translate('%d week'), translate('%d weeks')),
+            (natural.date.TIME_DAY, translate('%d day'), translate('%d days')),
+            (natural.date.TIME_HOUR, translate('%d hour'), translate('%d hours')),
+            (natural.date.TIME_MINUTE, translate('%d minute'), translate('%d minutes')),
+            (1, translate('%d second'), translate('%d seconds')),
+        ]
+        # Counts don't need the catalog, but `natural` asks for the locale's
+        # number conventions twice per count, which is about as slow. There
+        # are only so many different counts, so remember them.
+        self.access_counts = {}
+
+    def render_access_count(self, inserts):
+        text = self.access_counts.get(inserts)
+        if text is None:
+            text = self.access_counts[inserts] = render_access_count(inserts)
+        return text
+
+    # The biggest unit that fits, and how much is left over. Seconds are never
+    # left over, as they're the smallest unit.
+    def render_amount(self, seconds):
+        for unit_seconds, singular, plural in self.units:
+            if seconds >= unit_seconds or unit_seconds == 1:
+                count, remainder = divmod(seconds, unit_seconds)
+                return (singular if count == 1 else plural) % (count,), remainder
+
+    # `now` is a naive local `datetime` without microseconds, and, like
+    # `natural`, we take the difference in local time, DST jumps and all.
+    def render_duration(self, t, now):
+        difference = datetime.datetime.fromtimestamp(t).replace(microsecond=0) - now
+        template = self.ago if difference < datetime.timedelta(0) else self.from_now
+        amount, remainder = self.render_amount(abs(difference.days * 86400 + difference.seconds))
+        if remainder:
+            return f'{amount}, {template % (self.render_amount(remainder)[0],)}'
+        else:
+            return template % (amount,)
+
+@functools.lru_cache(maxsize=8)
+def get_subtitle_templates(translate):
+    return SubtitleTemplates(translate)
+
+def render_subtitle(attrs, templates, now):
     return '{}, {}, {:.2g}%'.format(
         # '-1' is to avoid a 'zero' last-seen, which would get rendered as '0
         # seconds from now' like it's in the future.
-        natural.date.duration(attrs["last_seen"] - 1, precision=2),
-        render_access_count(attrs["inserts"]),
+        templates.render_duration(attrs["last_seen"] - 1, now),
+        templates.render_access_count(attrs["inserts"]),
         100 * attrs["score_frac"],
     )
 
@@ -354,11 +2735,14 @@ class OpenStatusFilter(Enum):
     CLOSED = 'closed'
     BOTH = 'both'
 
-def get_data_list_for_panel(history, window, open_status_filter):
+# Scores are the entries' frecencies, unless given in `scores`, a map from path
+# key to score.
+def get_data_list_for_panel(history, window, open_status_filter, scores=None):
     now = get_time_seconds()
     window_folders = window.folders()
 
-    for path, attrs in history.items():
+    for path_key, entry in history.items():
+        path = path_table.get_path(path_key)
         is_open = window.find_open_file(path) is not None
 
         if ((is_open and open_status_filter == OpenStatusFilter.CLOSED)
@@ -367,34 +2751,81 @@ def get_data_list_for_panel(history, window, open_status_filter):
         else:
             yield dict(
                 path=path,
-                score=entry_frecency(attrs, now),
+                score=entry_frecency(entry, now) if scores is None else scores[path_key],
                 is_open=is_open,
                 is_within_folders=any(path.startswith(folder) for folder in window_folders),
-                **attrs
+                added=entry.added,
+                last_seen=entry.last_seen,
+                inserts=entry.inserts,
             )
 
 class OpenFrecentFileCommand(sublime_plugin.WindowCommand):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        with timed_operation('Load state from file'):
-            load_and_populate_state_from_file(get_history_path())
-
-    def run(self, use_master=False, open_status_filter=OpenStatusFilter.BOTH.value):
+        # Bumped on every highlight, so a delayed preview can tell if the user
+        # has moved on since it was scheduled.
+        self.preview_token = 0
+        # Bumped every time we show the panel, so callbacks from a panel we've
+        # since replaced can tell they're stale.
+        self.panel_generation = 0
+        # The load populates the windows open at the time. Windows opened since
+        # need doing here.
+        if is_history_loaded():
+            with timed_operation('Populate window history'):
+                start_window_population(self.window, TaskPriority.HIGH)
+                populate_window_history_from_views(self.window)
+        else:
+            start_history_load()
+
+    # With `related`, show the files that usually come after the current one,
+    # from anywhere in the history, ranked by how often they do.
+    def run(self, use_master=False, open_status_filter=OpenStatusFilter.BOTH.value, related=False):
+        count_event('panel_runs')
+        trace_event(self.window, 'p', use_master, open_status_filter, related)
+        with profiled_operation():
+            self.show_panel(use_master, open_status_filter, self.window.active_view(), related)
+
+    # Show what we have so far, and again once the load or the population of
+    # this window finishes, unless the panel has been closed or replaced by
+    # then.
+    def show_panel(self, use_master, open_status_filter, original_view, related):
+        self.panel_generation += 1
+        if not is_history_loaded():
+            count_event('panels_before_load')
+            pending = history_load['future']
+        elif not use_master and not related:
+            pending = get_window_population(self.window.id())
+        else:
+            pending = None
+        if pending is not None:
+            pending.add_done_callback(functools.partial(
+                self.on_history_ready,
+                self.panel_generation, use_master, open_status_filter, original_view, related,
+            ))
         try:
             open_status_filter = OpenStatusFilter(open_status_filter)
         except ValueError:
-            log_debug(f'Got unexpected open_status_filter: {open_status_filter}')
-
-        history = (
-            global_state['master_history']
-            if use_master
-            else get_window_history(self.window)
-        )
+            logger.warning('Got unexpected open_status_filter: %s', open_status_filter)
+
+        snapshot = history_state.snapshot(window_ids=(self.window.id(),))
+        scores = None
+        if related:
+            path = original_view.file_name() if original_view is not None else None
+            path_key = path_table.lookup(path) if path is not None else None
+            scores = get_related_paths(path_key, snapshot.master_history) if path_key is not None else {}
+            if not scores:
+                sublime.status_message('FrecentHistory: No files seen after this one yet')
+                return
+            history = {related_key: snapshot.master_history[related_key] for related_key in scores}
+        elif use_master:
+            history = snapshot.master_history
+        else:
+            history = snapshot.get_window_history(self.window.id())
 
         with timed_operation('Get panel data'):
             entry_data_list = sorted(
-                get_data_list_for_panel(history, self.window, open_status_filter),
+                get_data_list_for_panel(history, self.window, open_status_filter, scores),
                 key=lambda x: x['score'],
                 reverse=True,
             )
@@ -406,50 +2837,145 @@ class OpenFrecentFileCommand(sublime_plugin.WindowCommand):
                 attrs['score_frac'] = attrs['score'] / total_score
 
         with timed_operation('Render display list'):
+            shorten_path = get_path_shortener(tuple(self.window.folders()))
+            subtitle_templates = get_subtitle_templates(natural.date._)
+            now = datetime.datetime.now().replace(microsecond=0)
             entry_display_list = [
                 [
                     '{} {}'.format(
                         get_symbol(attrs['is_open'], attrs['is_within_folders']),
-                        shorten_path(attrs['path'], self.window.folders()),
+                        shorten_path(attrs['path']),
                     ),
-                    render_subtitle(attrs),
+                    render_subtitle(attrs, subtitle_templates, now),
                 ]
                 for attrs in entry_data_list
             ]
 
+        global_state['previewed_paths'].clear()
         global_state['active'] = True
         self.window.show_quick_panel(
             entry_display_list,
-            functools.partial(self.open_file, entry_data_list, self.window.active_view()),
+            functools.partial(self.open_file, entry_data_list, original_view, self.panel_generation),
             flags=sublime.KEEP_OPEN_ON_FOCUS_LOST,
             on_highlight=functools.partial(self.preview_selection, entry_data_list),
             selected_index=0,
         )
 
+    # Scrolling quickly through the panel would open a view for every entry we
+    # pass, so only preview an entry once it has stayed highlighted for a bit.
     def preview_selection(self, entry_data_list, selected_index):
+        self.preview_token += 1
         if selected_index >= 0 and get_show_file_preview():
-            path = entry_data_list[selected_index]['path']
-            if historied_path_exists(path):
+            sublime.set_timeout(
+                functools.partial(
+                    self.preview_path,
+                    entry_data_list[selected_index]['path'],
+                    self.preview_token,
+                ),
+                get_file_preview_delay_ms(),
+            )
+
+    def preview_path(self, path, preview_token):
+        # The highlight moved, or the panel closed, while we were waiting.
+        if preview_token != self.preview_token:
+            return
+        existence = check_historied_path_exists(path)
+        if existence != PathExistence.EXISTS:
+            if existence == PathExistence.UNKNOWN:
+                sublime.status_message(f'FrecentHistory: Not previewing {path}: not responding')
+            return
+        if get_file_preview_mode() == FilePreviewMode.SNIPPET:
+            show_file_snippet(self.window, path)
+        else:
+            skip_reason = get_preview_skip_reason(path)
+            if skip_reason is None:
+                global_state['previewed_paths'].add((self.window.id(), path))
                 self.window.open_file(
                     path,
                     sublime.FORCE_GROUP | sublime.TRANSIENT
                 )
-
-    def open_file(self, entry_data_list, original_view, selected_index):
+            else:
+                sublime.status_message(f'FrecentHistory: Not previewing {path}: {skip_reason}')
+
+    # Called on the loading thread, or the async thread for a population.
+    def on_history_ready(self, generation, use_master, open_status_filter, original_view, related, _future):
+        sublime.set_timeout(functools.partial(
+            self.refresh_panel, generation, use_master, open_status_filter, original_view, related,
+        ), 0)
+
+    def refresh_panel(self, generation, use_master, open_status_filter, original_view, related):
+        if generation == self.panel_generation and global_state['active']:
+            logger.debug('Refreshing panel now the history is ready')
+            self.show_panel(use_master, open_status_filter, original_view, related)
+
+    def open_file(self, entry_data_list, original_view, generation, selected_index):
+        # Replacing the panel closes the old one, and we don't want to act on
+        # that.
+        if generation != self.panel_generation:
+            return
         global_state['active'] = False
+        # Drop any preview that is still waiting to happen.
+        self.preview_token += 1
+        if get_show_file_preview() and get_file_preview_mode() == FilePreviewMode.SNIPPET:
+            hide_file_snippet(self.window)
+
+        trace_event(
+            self.window,
+            's',
+            selected_index,
+            entry_data_list[selected_index]['path'] if selected_index >= 0 else None,
+        )
 
         # Cancelled entry, focus on active view when comand was run.
         if selected_index < 0:
             self.window.focus_view(original_view)
         else:
             path = entry_data_list[selected_index]['path']
-            if historied_path_exists(path):
+            # If we can't tell whether it's there, the user picked it, so let
+            # Sublime try.
+            if check_historied_path_exists(path) != PathExistence.MISSING:
                 self.window.open_file(
                     path,
                 )
 
+        # Catch up on anything that happened while the panel was open.
+        sublime.set_timeout_async(replay_deferred_activations, 0)
+
         # We might have found some paths that didn't exist during our
         # previewing, so collect any garbage.
-        remove_paths_to_remove()
+        start_task('Remove garbage paths', remove_paths_to_remove_in_steps(), TaskPriority.LOW)
+
+class CaptureFrecentProfileCommand(sublime_plugin.WindowCommand):
+
+    def run(self, operations=10, cprofile=True, tracemalloc=True):  # pylint: disable=redefined-outer-name
+        start_profile_capture(operations, use_cprofile=cprofile, use_tracemalloc=tracemalloc)
+        sublime.status_message(
+            f'FrecentHistory: Profiling the next {operations} panel runs and activation batches'
+        )
+
+class ShowFrecentPerformanceStatsCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        show_report(self.window, 'FrecentHistory performance stats', render_metrics())
+
+class ShowFrecentMemoryUsageCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        # Walking a big history takes a while, so do it off the main thread.
+        sublime.set_timeout_async(self.measure, 0)
+
+    def measure(self):
+        with timed_operation('Measure memory usage'):
+            text = render_memory_report()
+        sublime.set_timeout(lambda: show_report(self.window, 'FrecentHistory memory usage', text), 0)
+
+class ShowFrecentLogCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        text = log_ring.render()
+        if not text:
+            sublime.status_message('FrecentHistory: Nothing logged yet')
+            return
+        show_report(self.window, 'FrecentHistory log', text)
 
 # /Comand.